@@ -0,0 +1,401 @@
+"""
+benchmarks.py
+Timings for the regularisation code so we can size jobs
+on full MODIS tiles (2400x2400 pixels)
+
+Run with eg:
+    python benchmarks.py penalty --nT 365 --ys 50 --xs 50
+    python benchmarks.py tdma --nTs 90 180 365 --sizes 100 400
+    python benchmarks.py dtype --nT 180 --ys 30 --xs 30
+    python benchmarks.py warm --nT 365
+    python benchmarks.py startup --target 1.5
+    python benchmarks.py brdf --nT 90 --ys 20 --xs 20
+    python benchmarks.py bvls --nT 90 --ys 50 --xs 50
+    python benchmarks.py robust --nT 120 --ys 30 --xs 30
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import regularisation
+import brdf
+
+MODIS_TILE = 2400
+
+
+def synthetic_refl(nT, ys, xs, frac_obs=0.4, seed=42):
+    """
+    Makes a fake reflectance cube with a seasonal signal,
+    a drop half way through (eg a fire) and missing obs set to 0
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(nT)
+    season = 0.3 + 0.05 * np.sin(2 * np.pi * t / 365.)
+    refl = np.repeat(season[:, None], ys * xs, axis=1).reshape((nT, ys, xs))
+    refl[nT//2:] -= 0.1
+    refl += 0.01 * rng.standard_normal(refl.shape)
+    refl[rng.random(refl.shape) > frac_obs] = 0
+    return refl.astype(np.float32)
+
+
+def timeit(func, *args, repeats=3, **kwargs):
+    """
+    Best of repeats wall time in seconds
+    """
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def to_tile(seconds, ys, xs):
+    """
+    Extrapolate a chunk timing to a full MODIS tile
+    """
+    return seconds * (MODIS_TILE * MODIS_TILE) / (ys * xs)
+
+
+def bench_penalty(nT=365, ys=50, xs=50, repeats=3):
+    """
+    Compare the closed form penalty_mats to the per-pixel bandmat
+    assembly on a chunk of a MODIS tile. Also checks they agree.
+    """
+    refl = synthetic_refl(nT, ys, xs)
+    Iobs = refl > 0
+    W = np.random.default_rng(0).random(refl.shape).astype(np.float32)
+    alpha = 100.
+    A, B, C, D = regularisation.prepare_mats(refl, alpha=alpha)
+    A2, B2, C2 = np.copy(A), np.copy(B), np.copy(C)
+    t_fast = timeit(regularisation.penalty_mats, W, Iobs, alpha, A, B, C,
+                    repeats=repeats)
+    t_bm = timeit(regularisation.penalty_mats_bandmat, W, Iobs, alpha,
+                  A2, B2, C2, repeats=1)
+    diff = max([np.abs(A - A2).max(), np.abs(B - B2).max(),
+                np.abs(C - C2).max()])
+    print(f"penalty assembly nT={nT} chunk={ys}x{xs}  max diff={diff:.3g}")
+    print(f"  bandmat      {t_bm:10.4f} s  ({to_tile(t_bm, ys, xs):10.1f} s per tile)")
+    print(f"  closed form  {t_fast:10.4f} s  ({to_tile(t_fast, ys, xs):10.1f} s per tile)")
+    print(f"  speed-up     {t_bm / t_fast:10.1f}x")
+    return t_bm, t_fast
+
+
+def bench_tdma(nTs=(90, 180, 365), sizes=(100, 200, 400), repeats=3):
+    """
+    Time the compiled TDMA_MAT against the numpy version over
+    a grid of time steps x square chunk sizes
+    """
+    # compile first so it isn't in the timings
+    A, B, C, D = regularisation.prepare_mats(synthetic_refl(10, 2, 2))
+    regularisation.TDMA_MAT(A, B, C, D)
+    print(f"{'nT':>5} {'chunk':>9} {'numpy s':>10} {'numba s':>10} "
+          f"{'speed-up':>9} {'tile s':>9} {'same':>5}")
+    results = []
+    for nT in nTs:
+        for size in sizes:
+            refl = synthetic_refl(nT, size, size)
+            A, B, C, D = regularisation.prepare_mats(refl, alpha=100.)
+            X = np.empty_like(D)
+            t_np = timeit(regularisation.TDMA_MAT_numpy, A, B, C, D,
+                          repeats=repeats)
+            t_nb = timeit(regularisation.TDMA_MAT, A, B, C, D, out=X,
+                          repeats=repeats)
+            same = np.array_equal(X, regularisation.TDMA_MAT_numpy(A, B, C, D))
+            print(f"{nT:5d} {size:4d}x{size:<4d} {t_np:10.4f} {t_nb:10.4f} "
+                  f"{t_np / t_nb:8.1f}x {to_tile(t_nb, size, size):9.2f} {str(same):>5}")
+            results.append((nT, size, t_np, t_nb))
+    return results
+
+
+def bench_dtype(nT=180, ys=30, xs=30):
+    """
+    Times edge_preserving in float32 against float64 on the same
+    OLCI-like cube and reports how far apart they are. The
+    regression check is tests/test_dtype.py.
+    """
+    refl = np.stack([synthetic_refl(nT, ys, xs, seed=band)
+                     for band in range(4)], axis=1)
+    out = {}
+    for dtype in [np.float64, np.float32]:
+        t0 = time.perf_counter()
+        solutions, uncs = regularisation.edge_preserving("OLCI", refl,
+                                                         dtype=dtype)
+        out[dtype] = (solutions, uncs, time.perf_counter() - t0)
+    s64, u64, t64 = out[np.float64]
+    s32, u32, t32 = out[np.float32]
+    fin64 = np.isfinite(s64).all(axis=(0, 1))
+    fin32 = np.isfinite(s32).all(axis=(0, 1))
+    both = fin64 & fin32
+    diff = np.abs(s64 - s32)[:, :, both].max(axis=(0, 1))
+    print(f"float32 vs float64 nT={nT} chunk={ys}x{xs}")
+    print(f"  pixels finite in both   {both.sum()} of {ys * xs}")
+    print(f"  finite in one only      {(fin64 != fin32).sum()}")
+    if diff.size:
+        print(f"  solutions median diff   {np.median(diff):.3g}")
+        print(f"  solutions max diff      {diff.max():.3g}")
+    print(f"  float64 {t64:.3f} s  float32 {t32:.3f} s")
+    return diff
+
+
+def bench_warm(nT=365, ys=50, xs=50, shift=1, margin=30):
+    """
+    Daily rolling window: warm started solve_band_warm against
+    a cold solve_band of the new window
+
+    The spread between cold solves of the old and new windows
+    over the same dates is printed too as a yardstick -- a
+    warm start can't be expected to do better than that.
+    """
+    full = synthetic_refl(nT + shift, ys, xs, frac_obs=0.6)
+    old, new = full[:nT], full[shift:]
+    X_old, W_old = regularisation.solve_band(old)[:2]
+    t0 = time.perf_counter()
+    X_cold = regularisation.solve_band(new)[0]
+    t_cold = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    X_warm, W_warm = regularisation.solve_band_warm(
+        new, W_old[shift:], X_old[shift:], margin=margin)
+    t_warm = time.perf_counter() - t0
+    ok = np.isfinite(X_cold).all(axis=0) & np.isfinite(X_warm).all(axis=0)
+    d_warm = np.abs(X_warm - X_cold)[:, ok]
+    d_ref = np.abs(X_old[shift:] - X_cold[:nT-shift])[:, ok]
+    print(f"warm start nT={nT} shift={shift} margin={margin} chunk={ys}x{xs}")
+    print(f"  cold {t_cold:.3f} s  warm {t_warm:.3f} s  ({t_cold / t_warm:.1f}x)")
+    print(f"  warm vs cold       median {np.median(d_warm):.3g}  "
+          f"99% {np.percentile(d_warm, 99):.3g}")
+    print(f"  cold old vs new    median {np.median(d_ref):.3g}  "
+          f"99% {np.percentile(d_ref, 99):.3g}")
+    return d_warm, d_ref
+
+
+def synthetic_brdf(nT, ys, xs, nBands=4, frac_obs=0.5, seed=42):
+    """
+    Fake qa, refl and (3, nT, ys, xs) kernels with kernel
+    weights near the edges of the [0, 0.6] bounds so some
+    pixels need the bounded solve
+    """
+    rng = np.random.default_rng(seed)
+    K = np.stack([np.ones((nT, ys, xs)),
+                  rng.uniform(-0.15, 0.4, (nT, ys, xs)),
+                  rng.uniform(-1.5, 0., (nT, ys, xs))])
+    x = rng.uniform(-0.02, 0.3, (3, nBands, ys, xs))
+    refl = np.einsum('ityx,ibyx->tbyx', K, x)
+    refl += 0.01 * rng.standard_normal(refl.shape)
+    qa = rng.random((nT, ys, xs)) < frac_obs
+    refl[~np.broadcast_to(qa[:, None], refl.shape)] = -1e4
+    return qa, refl.astype(np.float32), K.astype(np.float32)
+
+
+def bench_brdf(nT=90, ys=20, xs=20):
+    """
+    Batched do_brdf_corr_batch against a per-pixel loop
+    of do_brdf_corr_multi_sns, checking they agree where
+    there are at least 3 obs (see bench_bvls)
+    """
+    qa, refl, K = synthetic_brdf(nT, ys, xs)
+    t0 = time.perf_counter()
+    iso, rmse, params = brdf.do_brdf_corr_batch(qa, refl, K)
+    t_batch = time.perf_counter() - t0
+    iso_ref = np.zeros_like(refl)
+    rmse_ref = np.zeros(rmse.shape)
+    t0 = time.perf_counter()
+    for y in range(ys):
+        for x in range(xs):
+            _iso, _rmse = brdf.do_brdf_corr_multi_sns(
+                None, qa[:, y, x], refl[:, :, y, x], K[:, :, y, x])
+            iso_ref[:, :, y, x] = _iso
+            rmse_ref[:, y, x] = _rmse
+    t_loop = time.perf_counter() - t0
+    print(f"brdf inversion nT={nT} chunk={ys}x{xs}")
+    print(f"  per-pixel {t_loop:.3f} s  ({to_tile(t_loop, ys, xs):.0f} s per tile)")
+    print(f"  batched   {t_batch:.3f} s  ({to_tile(t_batch, ys, xs):.0f} s per tile)")
+    print(f"  speed-up  {t_loop / t_batch:.1f}x")
+    ok = (qa[:, None] & (refl > 0)).sum(axis=0) >= 3
+    print(f"  iso max diff   {np.abs(iso - iso_ref).max(axis=0)[ok].max():.3g}")
+    print(f"  rmse max diff  {np.nanmax(np.abs(rmse - rmse_ref)):.3g}")
+    return t_loop, t_batch
+
+
+def check_robust(nT=120, ys=30, xs=30, passes=1, shadow=0.04):
+    """
+    Robust mode of do_brdf_corr_batch against a per-pixel loop of
+    do_brdf_corr_multi_sns_old, on synthetic data with a fraction
+    of obs darkened like cloud shadows. The old code always uses
+    bounds of (0, 1) and falls over on degenerate pixels, those
+    are left out.
+    """
+    qa, refl, K = synthetic_brdf(nT, ys, xs)
+    rng = np.random.default_rng(1)
+    refl[(rng.random(refl.shape) < shadow) & (refl > 0)] *= 0.5
+    t0 = time.perf_counter()
+    iso = brdf.do_brdf_corr_batch(qa, refl, K, bounds=(0, 1),
+                                  robust_passes=passes)[0]
+    t_batch = time.perf_counter() - t0
+    iso_ref = np.full_like(iso, np.nan)
+    t0 = time.perf_counter()
+    for y in range(ys):
+        for x in range(xs):
+            try:
+                iso_ref[:, :, y, x] = brdf.do_brdf_corr_multi_sns_old(
+                    None, qa[:, y, x], refl[:, :, y, x].copy(), K[:, :, y, x])[0]
+            except (np.linalg.LinAlgError, ValueError):
+                pass
+    t_loop = time.perf_counter() - t0
+    ok = (((qa[:, None] & (refl > 0)).sum(axis=0) >= 3)
+          & np.isfinite(iso_ref).all(axis=0))
+    nRej = ((refl > 0) & qa[:, None] & (iso == 0)).sum()
+    print(f"robust brdf nT={nT} chunk={ys}x{xs} passes={passes}")
+    print(f"  per-pixel {t_loop:.3f} s  batched {t_batch:.3f} s  "
+          f"({t_loop / t_batch:.1f}x)")
+    print(f"  obs rejected   {nRej}")
+    print(f"  iso max diff   {np.abs(iso - iso_ref).max(axis=0)[ok].max():.3g}")
+    print(f"  rejections differ {((iso == 0) != (iso_ref == 0))[:, ok].sum()}")
+    return iso, iso_ref
+
+
+def bench_bvls(nT=90, ys=50, xs=50):
+    """
+    Compiled bvls_batch against scipy's bvls on the synthetic
+    kernel matrices of a chunk, one band, all pixels bounded.
+    With fewer than 3 obs there are many solutions with the same
+    cost so only the costs are compared for those.
+    """
+    qa, refl, K = synthetic_brdf(nT, ys, xs, nBands=1)
+    K = K.reshape((3, nT, -1)).astype(np.float64)
+    y = refl[:, 0].reshape((nT, -1)).astype(np.float64)
+    mask = qa.reshape((nT, -1)) & (y > 0)
+    y = np.where(mask, y, 0)
+    KtK = np.einsum('itp,jtp->pij', K * mask, K)
+    Kty = np.einsum('itp,tp->pi', K * mask, y)
+    # compile first so it isn't in the timings
+    brdf.bvls_batch(KtK[:2], Kty[:2])
+    t0 = time.perf_counter()
+    x_nb = brdf.bvls_batch(KtK, Kty)
+    t_nb = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    x_sp = brdf._bounded_fallback(K, y, mask, np.arange(ys * xs))
+    t_sp = time.perf_counter() - t0
+
+    def cost(x):
+        r = np.einsum('itp,pi->tp', K, x) - y
+        return (np.where(mask, r, 0)**2).sum(axis=0)
+    print(f"bounded lsq nT={nT} pixels={ys * xs}")
+    print(f"  scipy    {t_sp:.3f} s  ({to_tile(t_sp, ys, xs):.0f} s per tile band)")
+    print(f"  compiled {t_nb:.3f} s  ({to_tile(t_nb, ys, xs):.1f} s per tile band)")
+    print(f"  speed-up {t_sp / t_nb:.0f}x")
+    ok = mask.sum(axis=0) >= 3
+    print(f"  x max diff     {np.abs(x_nb - x_sp)[ok].max():.3g}  "
+          f"({ok.sum()} pixels with 3+ obs)")
+    print(f"  cost max diff  {(cost(x_nb) - cost(x_sp)).max():.3g}")
+    return t_sp, t_nb
+
+
+STARTUP_CODE = """
+import time
+t0 = time.perf_counter()
+import regularisation
+t1 = time.perf_counter()
+A, B, C, D = regularisation.prepare_mats(regularisation.np.ones((10, 2, 2)))
+regularisation.TDMA_MAT(A, B, C, D)
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t1)
+"""
+
+
+def _worker_ready(_=None):
+    """
+    What a pool worker does before it can take a chunk
+    """
+    A, B, C, D = regularisation.prepare_mats(np.ones((10, 2, 2)))
+    regularisation.TDMA_MAT(A, B, C, D)
+    return os.getpid()
+
+
+def bench_startup(repeats=5, workers=None, target=None):
+    """
+    Time a fresh interpreter importing regularisation and
+    running its first (cached) numba solve, and a spawned
+    worker getting ready. Spawned workers also import the main
+    module (here benchmarks, which pulls in brdf) so the worker
+    time is what a pool pays per worker over the bare import.
+    With a target (s) asserts the fresh interpreter is ready
+    in less than that.
+    """
+    env = dict(os.environ)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join([here, env.get('PYTHONPATH', '')])
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', STARTUP_CODE], env=env,
+                             capture_output=True, text=True, check=True)
+        wall = time.perf_counter() - t0
+        times.append([float(t) for t in out.stdout.split()] + [wall])
+    t_import, t_first, t_ready = np.min(times, axis=0)
+    print(f"startup (best of {repeats})")
+    print(f"  import regularisation    {t_import:.3f} s")
+    print(f"  first solve              {t_first:.3f} s")
+    print(f"  interpreter to ready     {t_ready:.3f} s")
+    ctx = multiprocessing.get_context('spawn')
+    t_worker = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            pool.submit(_worker_ready).result()
+        t_worker = min(t_worker, time.perf_counter() - t0)
+    print(f"  spawned worker ready     {t_worker:.3f} s")
+    workers = workers or os.cpu_count()
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        list(pool.map(_worker_ready, range(workers)))
+    t_pool = time.perf_counter() - t0
+    print(f"  {workers} spawned workers ready  {t_pool:.3f} s ({os.cpu_count()} cpus)")
+    if target is not None:
+        assert t_ready < target, \
+            f"fresh interpreter took {t_ready:.3f} s to be ready, target {target:.3f} s"
+    return t_import, t_first, t_ready, t_worker, t_pool
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for the regularisation code.')
+    parser.add_argument('which', choices=['penalty', 'tdma', 'dtype', 'warm', 'startup',
+                                          'brdf', 'bvls', 'robust'],
+                        help='Which benchmark to run')
+    parser.add_argument('--nT', type=int, default=365,
+                        help='Number of time steps')
+    parser.add_argument('--ys', type=int, default=50,
+                        help='Chunk rows (of a 2400x2400 tile)')
+    parser.add_argument('--xs', type=int, default=50,
+                        help='Chunk columns (of a 2400x2400 tile)')
+    parser.add_argument('--nTs', type=int, nargs='+', default=[90, 180, 365],
+                        help='Time steps to try (tdma)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 200, 400],
+                        help='Square chunk sizes to try (tdma)')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Best of this many runs')
+    parser.add_argument('--target', type=float, default=None,
+                        help='Fail if a fresh interpreter takes longer (s) to be ready (startup)')
+    args = parser.parse_args()
+
+    if args.which == 'penalty':
+        bench_penalty(args.nT, args.ys, args.xs, args.repeats)
+    elif args.which == 'tdma':
+        bench_tdma(args.nTs, args.sizes, args.repeats)
+    elif args.which == 'dtype':
+        bench_dtype(args.nT, args.ys, args.xs)
+    elif args.which == 'warm':
+        bench_warm(args.nT, args.ys, args.xs)
+    elif args.which == 'startup':
+        bench_startup(args.repeats, target=args.target)
+    elif args.which == 'brdf':
+        bench_brdf(args.nT, args.ys, args.xs)
+    elif args.which == 'bvls':
+        bench_bvls(args.nT, args.ys, args.xs)
+    elif args.which == 'robust':
+        check_robust(args.nT, args.ys, args.xs)
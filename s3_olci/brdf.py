@@ -6,6 +6,7 @@ of NBAR
 Maybe consider a c-factor correction too?
 """
 import numpy as np
+import numba as nb
 import scipy.optimize
 
 global MODIS_C_obs
@@ -23,6 +24,8 @@ def do_brdf_corr_multi_sns(doys, qa, refl, K):
     band_rmse = np.zeros(nBands)
     for band in range(nBands):
         fix_qa = np.logical_and(qa, refl[:, band] > 0)
+        # no kernels (nan) where the angles were bad
+        fix_qa &= np.isfinite(K).all(axis=0)
         y = refl[fix_qa, band]
         KK = K.T[fix_qa]
         #x = scipy.optimize.lsq_linear(KK, y, bounds=(0, 1), method='bvls').x
@@ -42,6 +45,251 @@ def do_brdf_corr_multi_sns(doys, qa, refl, K):
     return iso, band_rmse
 
 
+def kernel_cube(kerns):
+    """
+    Stacks the Kernels from OLCI_refl.loadData into a
+    (3, nT, ys, xs) cube of [Isotropic, Ross, Li]
+    """
+    return np.stack([kerns.Isotropic, kerns.Ross, kerns.Li])
+
+
+def _normal_solve(KtK, Kty, nObs):
+    """
+    Solves a stack of 3x3 normal equations
+
+    Pixels with too few obs or a near singular KtK get the
+    minimum norm (pinv) solution -- the same as lstsq gives
+    """
+    det = np.linalg.det(KtK)
+    scale = np.trace(KtK, axis1=1, axis2=2)**3
+    ok = (nObs >= 3) & (np.abs(det) > 1e-10 * scale)
+    x = np.zeros(Kty.shape)
+    x[ok] = np.linalg.solve(KtK[ok], Kty[ok][:, :, None])[:, :, 0]
+    bad = ~ok
+    if bad.any():
+        x[bad] = np.einsum('pij,pj->pi', np.linalg.pinv(KtK[bad]), Kty[bad])
+    return x
+
+
+def _bounded_fallback(K, y, mask, idx, bounds=(0, 0.6)):
+    """
+    Bounded solve for the pixels in idx, one at a time
+    """
+    x = np.zeros((len(idx), K.shape[0]))
+    for n, p in enumerate(idx):
+        m = mask[:, p]
+        x[n] = scipy.optimize.lsq_linear(K[:, m, p].T, y[m, p],
+                                         bounds=bounds, method='bvls').x
+    return x
+
+
+@nb.njit(cache=True)
+def _solve_free(A, b, free, x, M, idx):
+    """
+    Solves A[free, free] x[free] = b[free] in place by gaussian
+    elimination with partial pivoting. False if singular.
+    M and idx are scratch space.
+    """
+    k = 0
+    for i in range(len(free)):
+        if free[i]:
+            idx[k] = i
+            k += 1
+    tol = 0.
+    for i in range(k):
+        for j in range(k):
+            M[i, j] = A[idx[i], idx[j]]
+        M[i, k] = b[idx[i]]
+        tol = max(tol, abs(M[i, i]))
+    tol *= 1e-12
+    for i in range(k):
+        piv = i
+        for r in range(i + 1, k):
+            if abs(M[r, i]) > abs(M[piv, i]):
+                piv = r
+        if abs(M[piv, i]) <= tol:
+            return False
+        for j in range(k + 1):
+            M[i, j], M[piv, j] = M[piv, j], M[i, j]
+        for r in range(i + 1, k):
+            f = M[r, i] / M[i, i]
+            for j in range(i, k + 1):
+                M[r, j] -= f * M[i, j]
+    for i in range(k - 1, -1, -1):
+        v = M[i, k]
+        for j in range(i + 1, k):
+            v -= M[i, j] * x[idx[j]]
+        x[idx[i]] = v / M[i, i]
+    return True
+
+
+@nb.njit(parallel=True, cache=True)
+def _bvls_kernel(KtK, Kty, lo, hi, X):
+    """
+    Bounded least squares from the normal equations of each pixel
+
+    With only a few parameters every active set can be tried --
+    each parameter is at its lower bound, free or at its upper
+    bound. The problem is convex so the feasible candidate with
+    the lowest cost is the solution. Singular candidates are
+    skipped, their minimum is on a smaller face which is tried
+    as well. Ties (eg fewer obs than parameters) go to the first
+    candidate found, ie the one with more parameters at the lower
+    bound, as bvls would.
+    """
+    nPix, n = Kty.shape
+    ncand = 3**n
+    for p in nb.prange(nPix):
+        A = KtK[p]
+        best = np.inf
+        x = np.empty(n)
+        free = np.empty(n, dtype=np.bool_)
+        b = np.empty(n)
+        M = np.empty((n, n + 1))
+        idx = np.empty(n, dtype=np.int64)
+        for code in range(ncand):
+            c = code
+            for i in range(n):
+                state = c % 3
+                c //= 3
+                free[i] = state == 1
+                x[i] = lo if state == 0 else hi
+            # move the fixed parameters to the right hand side
+            for i in range(n):
+                b[i] = Kty[p, i]
+                for j in range(n):
+                    if not free[j]:
+                        b[i] -= A[i, j] * x[j]
+            if free.any() and not _solve_free(A, b, free, x, M, idx):
+                continue
+            feasible = True
+            for i in range(n):
+                if free[i] and (x[i] < lo or x[i] > hi):
+                    feasible = False
+            if not feasible:
+                continue
+            # cost without the constant y.T y
+            cost = 0.
+            for i in range(n):
+                cost -= 2 * Kty[p, i] * x[i]
+                for j in range(n):
+                    cost += x[i] * A[i, j] * x[j]
+            if best == np.inf or cost < best - 1e-12 * abs(best):
+                best = cost
+                X[p] = x
+
+
+def bvls_batch(KtK, Kty, bounds=(0, 0.6)):
+    """
+    Bounded least squares for a stack of small problems
+
+    KtK is (nPix, n, n) and Kty is (nPix, n) -- the normal
+    equations of each pixel. Gives the same solutions as
+    scipy.optimize.lsq_linear(..., method='bvls') but compiled
+    and in bulk. Meant for n of 3 or so, the cost grows as 3**n.
+    """
+    KtK = np.ascontiguousarray(KtK, dtype=np.float64)
+    Kty = np.ascontiguousarray(Kty, dtype=np.float64)
+    X = np.zeros(Kty.shape)
+    _bvls_kernel(KtK, Kty, float(bounds[0]), float(bounds[1]), X)
+    return X
+
+
+def _normal_eqs(K, y, mask):
+    """
+    Masked normal equations of each pixel from (nK, nT, nPix) kernels
+    """
+    Km = K * mask
+    KtK = np.einsum('itp,jtp->pij', Km, K)
+    Kty = np.einsum('itp,tp->pi', Km, y)
+    return KtK, Kty, mask.sum(axis=0)
+
+
+@np.errstate(all='ignore')
+def _reject_outliers(K, y, mask, x, z_T=2, max_frac=10):
+    """
+    One z-score pass of do_brdf_corr_multi_sns_old for all pixels
+
+    Obs with a residual over z_T times the rmse are dropped from
+    mask, but only in pixels where less than max_frac percent of
+    the obs are flagged -- otherwise it is the model that is off.
+    The flagged pixels are re-solved. Returns the pixels changed.
+    """
+    res = np.where(mask, np.einsum('itp,pi->tp', K, x) - y, 0)
+    nObs = mask.sum(axis=0)
+    rmse = np.sqrt((res**2).sum(axis=0) / nObs)
+    flag = mask & (np.abs(res) > z_T * rmse)
+    nFlag = flag.sum(axis=0)
+    idx = np.nonzero((nFlag > 0) & (100 * nFlag < max_frac * nObs))[0]
+    if len(idx):
+        mask[:, idx] &= ~flag[:, idx]
+        KtK, Kty, n = _normal_eqs(K.take(idx, axis=2), y.take(idx, axis=1),
+                                  mask.take(idx, axis=1))
+        x[idx] = _normal_solve(KtK, Kty, n)
+    return idx
+
+
+def do_brdf_corr_batch(qa, refl, K, bounds=(0, 0.6), use_scipy=False,
+                       robust_passes=0, z_T=2, max_frac=10):
+    """
+    Batched version of do_brdf_corr_multi_sns for a whole chunk
+
+    qa is (nT, ys, xs), refl is (nT, nBands, ys, xs) and
+    K is the (3, nT, ys, xs) kernel_cube, as from OLCI_refl.loadData
+    (obs with nan kernels are left out).
+    All pixels are solved together with masked normal equations
+    and only pixels outside the bounds get the bounded solver --
+    bvls_batch, or scipy's bvls one pixel at a time if use_scipy
+    (slow, kept for validation).
+
+    robust_passes > 0 turns on the z-score outlier rejection of
+    do_brdf_corr_multi_sns_old (eg for cloud shadows), repeated
+    that many times. Rejected obs are 0 in iso like missing ones.
+
+    Returns iso (the obs with the angular part removed, the same
+    as do_brdf_corr_multi_sns), the per-band rmse (nBands, ys, xs)
+    and the kernel weights (3, nBands, ys, xs).
+    """
+    nT, nBands, ys, xs = refl.shape
+    nK = K.shape[0]
+    K = K.reshape((nK, nT, ys * xs)).astype(np.float64)
+    qa = qa.reshape((nT, ys * xs)).astype(bool)
+    # obs with no kernels (nan where the angles were bad) can't be used
+    ok = np.isfinite(K).all(axis=0)
+    qa &= ok
+    K = np.where(ok, K, 0)
+    iso = np.zeros_like(refl)
+    band_rmse = np.zeros((nBands, ys * xs))
+    params = np.zeros((nK, nBands, ys * xs))
+    for band in range(nBands):
+        y = refl[:, band].reshape((nT, ys * xs)).astype(np.float64)
+        mask = qa & (y > 0)
+        y = np.where(mask, y, 0)
+        KtK, Kty, nObs = _normal_eqs(K, y, mask)
+        x = _normal_solve(KtK, Kty, nObs)
+        if robust_passes:
+            for _ in range(robust_passes):
+                if not len(_reject_outliers(K, y, mask, x, z_T, max_frac)):
+                    break
+            KtK, Kty, nObs = _normal_eqs(K, y, mask)
+        out = ((x < bounds[0]) | (x > bounds[1])).any(axis=1)
+        idx = np.nonzero(out)[0]
+        if len(idx):
+            if use_scipy:
+                x[idx] = _bounded_fallback(K, y, mask, idx, bounds)
+            else:
+                x[idx] = bvls_batch(KtK[idx], Kty[idx], bounds)
+        # angular part of each ob and residuals
+        brdf = np.einsum('itp,pi->tp', K[1:], x[:, 1:])
+        res = np.where(mask, (brdf + K[0] * x[:, 0] - y)**2, 0)
+        with np.errstate(all='ignore'):
+            band_rmse[band] = np.sqrt(res.sum(axis=0) / nObs)
+        iso[:, band] = np.where(mask, y - brdf, 0).reshape((nT, ys, xs))
+        params[:, band] = x.T
+    return (iso, band_rmse.reshape((nBands, ys, xs)),
+            params.reshape((nK, nBands, ys, xs)))
+
+
 def do_brdf_corr_multi_sns_old(doys, qa, refl, K):
     """
     try a simple fast solver...
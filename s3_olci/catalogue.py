@@ -0,0 +1,245 @@
+"""
+catalogue.py
+SQLite index of the .tif files in a tile directory
+
+Globbing a directory with years of daily files and parsing
+dates out of the names on every run is slow on the parallel
+filesystem. A TileCatalogue keeps the date, platform, path,
+size and valid pixel fraction of each file in a small database
+next to the files. Whatever writes the files add()s them (or
+update() from the CLI picks up new ones) and loaders only query
+it, read only, with find_files(). A new catalogue starts with a
+full update() so it never holds just the files add()ed since.
+
+    python catalogue.py /work/scratch/jbrennan01/data/S3/intermediate/h20v08/ --intermediate
+"""
+import os
+import sqlite3
+import logging
+import argparse
+import datetime
+import time
+import urllib.request
+import rasterio
+from rasterio.errors import RasterioError
+
+LOG = logging.getLogger(__name__)
+
+DB_NAME = "catalogue.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    platform TEXT,
+    size INTEGER,
+    mtime REAL,
+    valid_frac REAL
+);
+CREATE INDEX IF NOT EXISTS files_date ON files (date);
+CREATE TABLE IF NOT EXISTS scans (
+    time REAL
+);
+"""
+
+
+def parse_gridded(name):
+    """
+    Date and platform of a daily gridded file eg S3_SY09_h20v08_20190101.tif
+    """
+    parts = name[:-4].split("_")
+    return datetime.datetime.strptime(parts[-1][:8], "%Y%m%d"), "_".join(parts[:2])
+
+
+def parse_intermediate(name):
+    """
+    Date and platform of a s3_pre_processor output eg
+    S3A_20190828T080936_306_h20v08.tif
+    """
+    parts = name[:-4].split("_")
+    return datetime.datetime.strptime(parts[-3][:8], "%Y%m%d"), parts[0]
+
+
+def valid_fraction(path, qa_band=5):
+    """
+    Fraction of pixels with a good qa
+    """
+    with rasterio.open(path) as src:
+        return float((src.read(qa_band) > 0).mean())
+
+
+class TileCatalogue(object):
+    """
+    Date indexed catalogue of the .tif files in a directory
+    """
+
+    def __init__(self, directory, parse=parse_gridded, db=None, qa_band=5,
+                 readonly=False):
+        self.directory = directory
+        self.parse = parse
+        # band used for the valid pixel fraction, None to skip it
+        self.qa_band = qa_band
+        self.db = db or os.path.join(directory, DB_NAME)
+        if readonly:
+            uri = f"file:{urllib.request.pathname2url(self.db)}?mode=ro"
+            self.con = sqlite3.connect(uri, uri=True, timeout=60)
+        else:
+            new = not os.path.exists(self.db)
+            self.con = sqlite3.connect(self.db, timeout=60)
+            self.con.executescript(SCHEMA)
+            if new or not self.complete():
+                # eg the first add() in a directory that already has
+                # files -- start from all of them, not just that one
+                self.update()
+
+    def close(self):
+        self.con.close()
+
+    def complete(self):
+        """
+        True once a full update() of the directory has been done
+        """
+        try:
+            return self.con.execute("SELECT COUNT(*) FROM scans").fetchone()[0] > 0
+        except sqlite3.OperationalError:
+            # made before scans were recorded
+            return False
+
+    def _row(self, path, stat=None):
+        """
+        Catalogue entry for a file
+        """
+        stat = stat or os.stat(path)
+        date, platform = self.parse(os.path.basename(path))
+        valid = None
+        if self.qa_band is not None:
+            try:
+                valid = valid_fraction(path, self.qa_band)
+            except (RasterioError, IndexError) as e:
+                LOG.warning(f"no valid fraction for {path}: {e}")
+        return (path, date.strftime("%Y-%m-%d"), platform, stat.st_size,
+                stat.st_mtime, valid)
+
+    def add(self, path):
+        """
+        Adds (or refreshes) one file eg just after writing it
+        """
+        with self.con:
+            self.con.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?)",
+                             self._row(path))
+
+    def update(self, rescan=False):
+        """
+        Brings the catalogue up to date with the directory
+
+        Only new files are parsed and read. Files that are gone
+        are dropped. With rescan files already known are checked
+        for changes in size or mtime as well (a stat each).
+        Returns the number of files added or changed.
+        """
+        known = {p: (s, m) for p, s, m in
+                 self.con.execute("SELECT path, size, mtime FROM files")}
+        rows = []
+        on_disk = set()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".tif"):
+                    continue
+                on_disk.add(entry.path)
+                if entry.path in known and not rescan:
+                    continue
+                stat = entry.stat()
+                if known.get(entry.path) == (stat.st_size, stat.st_mtime):
+                    continue
+                try:
+                    rows.append(self._row(entry.path, stat))
+                except ValueError:
+                    LOG.warning(f"can't get a date from {entry.name}")
+        gone = [(p,) for p in set(known) - on_disk]
+        with self.con:
+            self.con.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?)",
+                                 rows)
+            self.con.executemany("DELETE FROM files WHERE path = ?", gone)
+            self.con.execute("DELETE FROM scans")
+            self.con.execute("INSERT INTO scans VALUES (?)", (time.time(),))
+        if rows or gone:
+            LOG.info(f"{self.directory}: {len(rows)} files added or changed, {len(gone)} removed")
+        return len(rows)
+
+    def query(self, start_date, end_date, platform=None, min_valid=None):
+        """
+        (date, path) of the files from start_date up to (not
+        including) end_date, sorted by date
+        """
+        sql = "SELECT date, path FROM files WHERE date >= ? AND date < ?"
+        args = [start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")]
+        if platform is not None:
+            sql += " AND platform = ?"
+            args.append(platform)
+        if min_valid is not None:
+            sql += " AND valid_frac >= ?"
+            args.append(min_valid)
+        sql += " ORDER BY date, path"
+        return [(datetime.datetime.strptime(d, "%Y-%m-%d"), p)
+                for d, p in self.con.execute(sql, args)]
+
+
+def scan_directory(directory, start_date, end_date, parse=parse_gridded):
+    """
+    (date, path) of the .tif files of a directory in a date range
+    from their names, without a catalogue
+    """
+    files = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not entry.name.endswith(".tif"):
+                continue
+            try:
+                date, _ = parse(entry.name)
+            except ValueError:
+                continue
+            if start_date <= date < end_date:
+                files.append((date, entry.path))
+    return sorted(files)
+
+
+def find_files(directory, start_date, end_date, parse=parse_gridded, **kwargs):
+    """
+    (date, path) of the files in a date range for loaders
+
+    Queries the directory's catalogue read only (kwargs go to
+    query()) and never updates it. Without a catalogue, or with
+    one that has never had a full update(), the directory is
+    scanned instead.
+    """
+    if os.path.exists(os.path.join(directory, DB_NAME)):
+        cat = TileCatalogue(directory, parse=parse, readonly=True)
+        try:
+            if cat.complete():
+                return cat.query(start_date, end_date, **kwargs)
+        finally:
+            cat.close()
+    LOG.warning(f"{directory} has no complete {DB_NAME}, scanning it "
+                f"(python catalogue.py {directory} to make one)")
+    return scan_directory(directory, start_date, end_date, parse)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build or update the file catalogue of a tile directory.')
+    parser.add_argument('directory', help='Directory of .tif files')
+    parser.add_argument('--intermediate', action='store_true',
+                        help='Files are s3_pre_processor outputs rather than daily gridded ones')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Check known files for changes too')
+    parser.add_argument('--no-valid', action='store_true',
+                        help="Don't read the files for the valid pixel fraction")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    cat = TileCatalogue(args.directory,
+                        parse=parse_intermediate if args.intermediate else parse_gridded,
+                        qa_band=None if args.no_valid else 5)
+    cat.update(rescan=args.rescan)
+    n, first, last = cat.con.execute(
+        "SELECT COUNT(*), MIN(date), MAX(date) FROM files").fetchone()
+    print(f"{n} files from {first} to {last}")
@@ -0,0 +1,21 @@
+"""
+chunks.py
+Splitting a MODIS tile into spatial chunks
+
+Shared by the scripts that work on a tile a chunk at a time
+(s3_regularise_tile.py, tile_store.py) so they agree on the
+windows.
+"""
+
+# pixels along a side of a 500 m MODIS tile
+TILE_SIZE = 2400
+
+
+def make_chunks(tile_size=TILE_SIZE, chunk_size=200):
+    """
+    Splits a tile into (ymin, ymax, xmin, xmax) windows
+    """
+    edges = list(range(0, tile_size, chunk_size)) + [tile_size]
+    return [(y0, y1, x0, x1)
+            for y0, y1 in zip(edges[:-1], edges[1:])
+            for x0, x1 in zip(edges[:-1], edges[1:])]
@@ -0,0 +1,113 @@
+"""
+masking.py
+QA, snow and angle screening of a loaded (ndays, bands, ys, xs)
+cube in one vectorised pass
+
+screen() gives a uint8 bitmask of the reasons each ob was
+screened out (0 is a good ob) and apply_mask() sets those obs
+of refl to the fill value in place. The reasons can be saved
+and loaded so BRDF and regularisation runs over the same chunk
+share them.
+"""
+import numpy as np
+
+# reason bits
+NO_FILE = 1     # no (readable) file for the day
+QA = 2          # qa band of the pre-processor says bad
+SNOW = 4        # NDVI at or under the snow threshold
+BLUE = 8        # Oa03 not positive -- B03 seems to have a better qa
+VZA = 16        # view zenith over the limit
+SZA = 32        # solar zenith over the limit
+
+REASONS = {'no_file': NO_FILE, 'qa': QA, 'snow': SNOW, 'blue': BLUE,
+           'vza': VZA, 'sza': SZA}
+
+# the tests loadData has always done
+DEFAULT_TESTS = dict(ndvi_snow=0., blue=True, max_vza=None, max_sza=None)
+
+# days done at a time, keeps the temporaries small
+BLOCK = 32
+
+
+@np.errstate(all='ignore')
+def screen(refl, qa, vza=None, sza=None, read=None, ndvi_snow=0.,
+           blue=True, max_vza=None, max_sza=None, block=BLOCK):
+    """
+    Reasons bitmask (ndays, ys, xs) for the OLCI bands
+    Oa03, Oa06, Oa08, Oa18 of refl
+
+    qa is True for good obs, read is True for the days that had a
+    file. ndvi_snow or max_vza/max_sza of None turn that test off.
+    Works on arrays or the compact cubes of olci_io.
+    """
+    nT, nBands, ys, xs = refl.shape
+    reasons = np.zeros((nT, ys, xs), dtype=np.uint8)
+    for t0 in range(0, nT, block):
+        tt = slice(t0, min(t0 + block, nT))
+        r = reasons[tt]
+        r[~np.asarray(qa[tt], dtype=bool)] |= QA
+        _refl = refl[tt]
+        if ndvi_snow is not None:
+            red, nir = _refl[:, 2], _refl[:, 3]
+            ndvi = (nir - red) / (nir + red)
+            r[ndvi <= ndvi_snow] |= SNOW
+        if blue:
+            r[_refl[:, 0] <= 0] |= BLUE
+        if max_vza is not None:
+            r[np.abs(vza[tt]) > max_vza] |= VZA
+        if max_sza is not None:
+            r[sza[tt] > max_sza] |= SZA
+    # days with no file are only that
+    if read is not None:
+        reasons[~np.asarray(read, dtype=bool)] = NO_FILE
+    return reasons
+
+
+def apply_mask(refl, reasons, fill=-1e04, block=BLOCK):
+    """
+    Sets the screened obs of refl to fill in place
+
+    Days with no file are left as they were loaded.
+    """
+    nT = refl.shape[0]
+    direct = isinstance(refl, np.ndarray)
+    for t0 in range(0, nT, block):
+        tt = slice(t0, min(t0 + block, nT))
+        bad = (reasons[tt] > 0) & (reasons[tt] != NO_FILE)
+        _refl = refl[tt]
+        np.copyto(_refl, fill, where=bad[:, None])
+        if not direct:
+            refl[tt] = _refl
+    return refl
+
+
+def describe(reasons):
+    """
+    Percentage of obs flagged for each reason
+    """
+    return {name: 100 * ((reasons & bit) > 0).mean()
+            for name, bit in REASONS.items()}
+
+
+def save_reasons(fname, reasons, tests, sources=""):
+    """
+    Saves a reasons bitmask along with the tests that made it and
+    a key of the data it was made from
+    """
+    np.savez_compressed(fname, reasons=reasons,
+                        tests=np.array(repr(sorted(tests.items()))),
+                        sources=np.array(sources))
+
+
+def load_reasons(fname, tests, sources=""):
+    """
+    Loads a saved reasons bitmask, None if it was made with other
+    tests or from other data (eg a day that had no file then has
+    one now)
+    """
+    with np.load(fname) as f:
+        if str(f['tests']) != repr(sorted(tests.items())):
+            return None
+        if 'sources' not in f or str(f['sources']) != sources:
+            return None
+        return f['reasons']
@@ -0,0 +1,114 @@
+"""
+modis_tiles.py
+Spatial index of the MODIS tile polygons
+
+Loading modis-tiles.geojson, buffer(0)-ing every polygon and
+testing a swath against all of them is most of the time it
+takes to find the tiles of a granule. A TileIndex does the
+loading once per process, keeps the fixed and prepared
+polygons in an STRtree and pickles them next to the geojson so
+later processes skip the parsing too.
+
+    index = get_index()
+    index.intersecting(swath)   # names of the tiles a swath hits
+"""
+import os
+import json
+import pickle
+import logging
+import numpy as np
+import shapely
+import shapely.wkt
+from shapely.geometry import shape
+
+LOG = logging.getLogger(__name__)
+
+TILES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "modis-tiles.geojson")
+
+# indices already loaded in this process
+_INDEX = {}
+
+
+def tile_name(feature):
+    return f"h{feature['properties']['ih']}v{feature['properties']['iv']}"
+
+
+class TileIndex(object):
+    """
+    STRtree of the tile polygons of a geojson
+    """
+
+    def __init__(self, names, geoms):
+        self.names = np.asarray(names)
+        self.geoms = np.asarray(geoms, dtype=object)
+        shapely.prepare(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+        self._by_name = {str(n): i for i, n in enumerate(self.names)}
+
+    @classmethod
+    def from_geojson(cls, fname):
+        with open(fname) as f:
+            features = json.load(f)["features"]
+        # NOTE: buffer(0) is a trick for fixing scenarios where polygons have overlapping coordinates
+        geoms = [shape(feature["geometry"]).buffer(0) for feature in features]
+        return cls([tile_name(f) for f in features], geoms)
+
+    def intersecting(self, geom):
+        """
+        Names of the tiles geom (eg a swath polygon) intersects
+        """
+        idx = self.tree.query(geom, predicate='intersects')
+        return self.names[np.sort(idx)]
+
+    def geometry(self, name):
+        """
+        Polygon of a tile eg h20v08, KeyError if it isn't in the
+        index (check with `name in index`)
+        """
+        return self.geoms[self._by_name[name]]
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __reduce__(self):
+        # the tree is rebuilt on load, the polygons go as WKB
+        return (TileIndex, (self.names, list(self.geoms)))
+
+
+def get_index(fname=TILES_FILE):
+    """
+    TileIndex of a tiles geojson, made once per process
+
+    Uses (and otherwise tries to write) a pickle next to the
+    geojson, remade if the geojson is newer.
+    """
+    if fname in _INDEX:
+        return _INDEX[fname]
+    cache = fname + ".pkl"
+    index = None
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(fname):
+        try:
+            with open(cache, "rb") as f:
+                index = pickle.load(f)
+        except Exception as e:
+            LOG.warning(f"can't load {cache}: {e}")
+    if index is None:
+        index = TileIndex.from_geojson(fname)
+        try:
+            tmp = f"{cache}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(index, f)
+            os.replace(tmp, cache)
+        except OSError as e:
+            LOG.info(f"can't write {cache}: {e}")
+    _INDEX[fname] = index
+    return index
+
+
+def swath_tiles(polygon_file, fname=TILES_FILE):
+    """
+    Tiles a granule's polygon.wkt intersects
+    """
+    with open(polygon_file) as f:
+        return get_index(fname).intersecting(shapely.wkt.loads(f.read()))
@@ -1,4 +1,3 @@
-
 """
 olci_io.py
 Assorted code for handling IO of observations...
@@ -6,21 +5,151 @@ Given the m month processing idea this will probably be rather
 complex. But can be aided by making lots of vrt files for:
 """
 import time
+import logging
+import hashlib
 import numpy as np
 from kernels import *
 import scipy.linalg
-import glob
-import gdal
 import datetime
+import netCDF4
 import copy
 from dateutil.relativedelta import relativedelta
 import os
 from rasterio.windows import Window
+from rasterio.errors import RasterioError
 import rasterio
+import rasterio.warp
 from affine import *
 import scipy.misc
 from skimage.transform import rescale, resize
+from concurrent.futures import ThreadPoolExecutor
+from catalogue import find_files
+import masking
+
+LOG = logging.getLogger(__name__)
+
+# band order in the gridded tiles from the s3 preprocessor
+OLCI_BANDS = ['Oa03', 'Oa06', 'Oa08', 'Oa18', 'qa', 'vza', 'sza', 'raa']
+
+# kernel values for the angle triplets this process has already seen,
+# one cache per angle_res keyed on the quantised angles -- see
+# OLCI_refl.compute_kernels
+_KERNEL_CACHE = {}
+
+
+# scales for the int16 cubes of OLCI_refl(compact=True)
+REFL_SCALE = 1e-4
+ANGLE_SCALE = 0.02
+
+
+class CompactCube(object):
+    """
+    Array held as scaled int16 and decoded when indexed
+
+    Only what is indexed is decoded so eg cube[:, band] is one
+    band's worth of floats. fill (eg the -1e04 of bad refl) and
+    non-finite values are kept as a nodata code.
+    """
+    NODATA = np.iinfo(np.int16).min
+
+    def __init__(self, shape, scale, fill=None, dtype=np.float32):
+        self.data = np.zeros(shape, dtype=np.int16)
+        self.scale = scale
+        self.fill = fill
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def encode(self, values):
+        values = np.asarray(values)
+        with np.errstate(invalid='ignore'):
+            codes = np.clip(np.round(values / self.scale), -32767, 32767)
+        bad = ~np.isfinite(values)
+        if self.fill is not None:
+            bad |= values == self.fill
+        return np.where(bad, self.NODATA, codes).astype(np.int16)
+
+    def decode(self, codes):
+        out = codes.astype(self.dtype) * self.dtype.type(self.scale)
+        if self.fill is not None:
+            out[codes == self.NODATA] = self.fill
+        return out
 
+    def __getitem__(self, key):
+        return self.decode(self.data[key])
+
+    def __setitem__(self, key, values):
+        self.data[key] = self.encode(values)
+
+    def __array__(self, dtype=None):
+        return self.astype(dtype or self.dtype)
+
+    def astype(self, dtype):
+        return self.decode(self.data).astype(dtype, copy=False)
+
+
+class BitMask(object):
+    """
+    Boolean (ndays, ys, xs) cube packed 8 pixels to a byte along x
+
+    Set and get a day (or slice of days) at a time, the rest of
+    an index is applied after unpacking.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.data = np.zeros(self.shape[:-1] + (-(-self.shape[-1] // 8),),
+                             dtype=np.uint8)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        t, rest = key[0], key[1:]
+        out = np.unpackbits(self.data[t], axis=-1,
+                            count=self.shape[-1]).view(bool)
+        if isinstance(t, slice) or np.ndim(t) > 0:
+            return out[(slice(None),) + rest]
+        return out[rest]
+
+    def __setitem__(self, t, values):
+        packed = self.data[t]
+        shape = packed.shape[:-1] + (self.shape[-1],)
+        values = np.broadcast_to(np.asarray(values, dtype=bool), shape)
+        self.data[t] = np.packbits(values, axis=-1)
+
+    def __array__(self, dtype=None):
+        return self.astype(dtype or bool)
+
+    def astype(self, dtype):
+        return self[:].astype(dtype, copy=False)
+
+
+class KernelCube(object):
+    """
+    The Isotropic, Ross and Li kernels for a (ndays, ys, xs) load
+    """
+
+    def __init__(self, Isotropic, Ross, Li):
+        self.Isotropic = Isotropic
+        self.Ross = Ross
+        self.Li = Li
 
 
 """
@@ -32,7 +161,10 @@ class OLCI_refl(object):
     BUT only data produced into the MODIS format by the s3 preprocessor
     """
 
-    def __init__(self, tile, start_date, end_date, xmin, ymin, xmax, ymax):
+    def __init__(self, tile, start_date, end_date, xmin, ymin, xmax, ymax,
+                 dtype=np.float32, angle_res=0.01, n_threads=8, store=None,
+                 compact=False, keep_angles=True, mask_tests=None,
+                 mask_cache=None):
         self.tile = tile
         self.start_date = start_date
         self.end_date = end_date
@@ -40,25 +172,315 @@ class OLCI_refl(object):
         self.ymin = ymin
         self.xmax = xmax
         self.ymax = ymax
+        # float type for the refl and angle arrays
+        self.dtype = dtype
+        # angles are quantised to this (degrees) for the kernel cache
+        self.angle_res = angle_res
+        # files are read on this many threads
+        self.n_threads = n_threads
+        # a tile store from tile_store.py to read instead of the daily files
+        self.store = store
+        # hold refl and angles as scaled int16 and qa as bits
+        self.compact = compact
+        # False to drop the angles once the kernels are done
+        self.keep_angles = keep_angles
+        # screening tests (see masking.screen) and a directory to keep
+        # the reasons bitmasks in so other runs can reuse them
+        self.mask_tests = dict(masking.DEFAULT_TESTS, **(mask_tests or {}))
+        self.mask_cache = mask_cache
         self.datadir = f"/work/scratch-nompiio/jbrennan01/data/s3/{tile}/"
 
-    def load_file(self, the_file):
+    def window(self):
         """
-        This loads the file...
+        The rasterio window of the chunk
         """
-        ds = gdal.Open(the_file)
-        data = ds.ReadAsArray(
-            yoff=int(self.ymin),
-            xoff=int(self.xmin),
-            ysize=int(self.ymax - self.ymin),
-            xsize=int(self.xmax - self.xmin))
-        self.ds = ds
-        return data
+        return Window(int(self.xmin), int(self.ymin),
+                      int(self.xmax - self.xmin), int(self.ymax - self.ymin))
+
+    def load_file(self, the_file, bands=OLCI_BANDS, out=None):
+        """
+        Reads only the named bands of the chunk from a file,
+        into out if given
+        """
+        indexes = [OLCI_BANDS.index(b) + 1 for b in bands]
+        with rasterio.open(the_file) as src:
+            return src.read(indexes, window=self.window(), out=out)
+
+    def allocate(self, ndays, ys, xs):
+        """
+        Empty refl, qa, vza, sza and raa cubes -- compact ones if asked for
+
+        qa is only ever good/bad so it is bool (or bits when compact).
+        """
+        if not self.compact:
+            return (np.zeros((ndays, 4, ys, xs), dtype=self.dtype),
+                    np.zeros((ndays, ys, xs), dtype=bool),
+                    np.zeros((ndays, ys, xs), dtype=self.dtype),
+                    np.zeros((ndays, ys, xs), dtype=self.dtype),
+                    np.zeros((ndays, ys, xs), dtype=self.dtype))
+        return ((CompactCube((ndays, 4, ys, xs), REFL_SCALE, fill=-1e04,
+                             dtype=self.dtype),
+                 BitMask((ndays, ys, xs))) +
+                tuple(CompactCube((ndays, ys, xs), ANGLE_SCALE, dtype=self.dtype)
+                      for _ in range(3)))
+
+    def load_day(self, the_file, j, refl, qa, vza, sza, raa):
+        """
+        Reads one daily file into day j of the output cubes
+
+        Plain arrays are read into directly, compact cubes
+        are encoded a day at a time. Nothing is screened here,
+        see screen.
+        """
+        direct = isinstance(refl, np.ndarray)
+        with rasterio.open(the_file) as src:
+            _refl = self._read(src, [1, 2, 3, 4],
+                               out=refl[j] if direct else None)
+            qa[j] = self._read(src, 5).astype(bool)
+            for cube, band in [(vza, 6), (sza, 7), (raa, 8)]:
+                day = self._read(src, band, out=cube[j] if direct else None)
+                if not direct:
+                    cube[j] = day
+        if not direct:
+            refl[j] = _refl
+
+    def _read(self, src, indexes, out=None):
+        """
+        Reads bands of the chunk from an open file
+        """
+        return src.read(indexes, window=self.window(), out=out)
+
+    def _store_read(self, nc, name, s0, s1):
+        """
+        Reads days s0:s1 of a store variable for the chunk
+        """
+        return nc[name][s0:s1, ..., self.ymin:self.ymax, self.xmin:self.xmax]
+
+    def _store_blocks(self, chunk):
+        """
+        (yblock, xblock) indices of the store blocks the chunk is in
+        """
+        by, bx = np.meshgrid(np.arange(self.ymin // chunk, -(-self.ymax // chunk)),
+                             np.arange(self.xmin // chunk, -(-self.xmax // chunk)),
+                             indexing='ij')
+        return by.ravel(), bx.ravel()
+
+    def _load_day(self, the_file, j, *cubes):
+        """
+        load_day but returns the error instead of raising
+        """
+        try:
+            self.load_day(the_file, j, *cubes)
+        except (RasterioError, OSError, ValueError) as e:
+            # leave the day empty like a missing one
+            for cube in cubes:
+                cube[j] = 0
+            return e
+
+    def compute_kernels(self, vza, sza, raa):
+        """
+        Kernels for the angle cubes
+
+        The angles come from tie-point grids upsampled with
+        nearest neighbour so there are few unique (vza, sza, raa)
+        triplets. The kernels are only computed once per unique
+        triplet (after rounding to angle_res degrees) and
+        scattered back. Triplets are remembered across loads in
+        the same process so chunked runs don't recompute them.
+
+        The kernels are in self.dtype. With compact cubes this
+        goes a day at a time so the angles are never all decoded.
+        """
+        shape = vza.shape
+        if not self.compact:
+            values = self._kernel_values(vza, sza, raa).astype(self.dtype)
+            return KernelCube(*[v.reshape(shape) for v in values])
+        out = np.empty((3,) + shape, dtype=self.dtype)
+        for j in range(shape[0]):
+            out[:, j] = self._kernel_values(vza[j], sza[j], raa[j]).reshape(
+                (3,) + shape[1:])
+        return KernelCube(*out)
+
+    def _kernel_values(self, vza, sza, raa):
+        """
+        (3, npix) kernel values for angle arrays through the cache
+
+        Pixels with a non-finite angle or one outside +-360 degrees
+        (eg the nodata of a compact cube) get nan kernels.
+        """
+        angles = [np.ravel(a) for a in (vza, sza, raa)]
+        with np.errstate(invalid='ignore'):
+            ok = np.logical_and.reduce([np.abs(a) <= 360 for a in angles])
+        out = np.full((3, ok.size), np.nan)
+        if not ok.any():
+            return out
+        # pack the quantised triplet into one int64 code
+        offset = int(round(360 / self.angle_res))
+        base = 2 * offset + 1
+        q = [np.round(a[ok] / self.angle_res).astype(np.int64) + offset
+             for a in angles]
+        codes = (q[0] * base + q[1]) * base + q[2]
+        uni, first, inv = np.unique(codes, return_index=True,
+                                    return_inverse=True)
+        # codes only mean the same triplet at the same angle_res
+        cache = _KERNEL_CACHE.setdefault(
+            self.angle_res, {'codes': np.zeros(0, dtype=np.int64),
+                             'values': np.zeros((3, 0))})
+        new = ~np.isin(uni, cache['codes'], assume_unique=True)
+        if new.any():
+            idx = first[new]
+            vza_, sza_, raa_ = [(qq[idx] - offset) * self.angle_res for qq in q]
+            kerns = Kernels(
+                vza_,
+                sza_, (raa_),
+                LiType='Sparse',
+                doIntegrals=False,
+                normalise=True,
+                RecipFlag=True,
+                RossHS=False,
+                MODISSPARSE=True,
+                RossType='Thick',
+                nbar=0.0)
+            values = np.stack([np.ravel(kerns.Isotropic) * np.ones(new.sum()),
+                               np.ravel(kerns.Ross), np.ravel(kerns.Li)])
+            codes_ = np.r_[cache['codes'], uni[new]]
+            values = np.c_[cache['values'], values]
+            order = np.argsort(codes_)
+            cache['codes'] = codes_[order]
+            cache['values'] = values[:, order]
+        pos = np.searchsorted(cache['codes'], uni)
+        out[:, ok] = cache['values'][:, pos[inv]]
+        return out
 
     def loadData(self):
         """
         Loads the viirs refl
         """
+        if self.store is None:
+            data = self.read_files()
+        else:
+            data = self.read_store()
+        self.screen(data)
+        """
+        compute the kernels for the angles
+        """
+        data['kernels'] = self.compute_kernels(data['vza'], data['sza'],
+                                               data['raa'])
+        if not self.keep_angles:
+            for name in ['vza', 'sza', 'raa']:
+                del data[name]
+        self.data = data
+
+    def mask_file(self):
+        """
+        Where the reasons bitmask of this chunk is cached
+        """
+        return os.path.join(
+            self.mask_cache,
+            f"{self.tile}_{self.start_date:%Y%m%d}_{self.end_date:%Y%m%d}_"
+            f"y{self.ymin}_{self.ymax}_x{self.xmin}_{self.xmax}.npz")
+
+    def sources_key(self, data):
+        """
+        Key of which days were read from which files and when those
+        files last changed
+        """
+        stamps = []
+        for f in sorted(set(str(f) for f in data['file'])):
+            stamps.append((f, os.path.getmtime(f) if os.path.exists(f) else None))
+        key = repr((stamps, np.flatnonzero(data['read']).tolist()))
+        return hashlib.md5(key.encode()).hexdigest()
+
+    def screen(self, data):
+        """
+        QA, snow and angle screening of a loaded chunk
+
+        Bad obs of refl are set to -1e04 and qa becomes True for
+        the good ones. data['reasons'] says why each ob was
+        screened out (see masking). With a mask_cache the reasons
+        are reused if the same chunk was screened with the same
+        tests from the same files before.
+        """
+        reasons = None
+        sources = self.sources_key(data) if self.mask_cache is not None else ""
+        if self.mask_cache is not None and os.path.exists(self.mask_file()):
+            reasons = masking.load_reasons(self.mask_file(), self.mask_tests,
+                                           sources)
+        if reasons is None:
+            reasons = masking.screen(data['refl'], data['qa'], data['vza'],
+                                     data['sza'], read=data['read'],
+                                     **self.mask_tests)
+            if self.mask_cache is not None:
+                os.makedirs(self.mask_cache, exist_ok=True)
+                masking.save_reasons(self.mask_file(), reasons, self.mask_tests,
+                                     sources)
+        masking.apply_mask(data['refl'], reasons)
+        data['qa'][:] = reasons == 0
+        data['reasons'] = reasons
+
+    def read_store(self):
+        """
+        Reads the chunk from a tile store made by tile_store.py
+
+        The store is chunked as (all days, y, x) so this is one
+        read per chunk rather than one per daily file. Gives the
+        same arrays as read_files.
+        """
+        ys = self.ymax - self.ymin
+        xs = self.xmax - self.xmin
+        ndays = (self.end_date - self.start_date).days
+        refl, qa, vza, sza, raa = self.allocate(ndays, ys, xs)
+        status = np.zeros(ndays, dtype=np.uint8)
+        with netCDF4.Dataset(self.store) as nc:
+            nc.set_auto_mask(False)
+            start = datetime.datetime.strptime(nc.start_date, "%Y-%m-%d")
+            t0 = (self.start_date - start).days
+            # days outside the store are left empty like missing ones
+            s0 = max(t0, 0)
+            s1 = min(t0 + ndays, len(nc.dimensions['time']))
+            if s1 > s0:
+                tt = slice(s0 - t0, s1 - t0)
+                refl[tt] = self._store_read(nc, 'refl', s0, s1)
+                qa[tt] = self._store_read(nc, 'qa', s0, s1)
+                vza[tt] = self._store_read(nc, 'vza', s0, s1)
+                sza[tt] = self._store_read(nc, 'sza', s0, s1)
+                raa[tt] = self._store_read(nc, 'raa', s0, s1)
+                # a day is only read if every block it came from was
+                by, bx = self._store_blocks(nc.chunk)
+                status[tt] = nc['status'][:, :, s0:s1][by, bx].max(axis=0)
+        days = [self.start_date + datetime.timedelta(days=int(d))
+                for d in range(ndays)]
+        dates = np.array([d for d, s in zip(days, status) if s > 0])
+        missing = [d for d, s in zip(days, status) if s == 0]
+        failed = {d: "could not be read when the store was made"
+                  for d, s in zip(days, status) if s == 2}
+        read = status == 1
+        # unread days are left empty like read_files does, screen()
+        # marks them NO_FILE and apply_mask leaves them alone
+        for j in np.flatnonzero(~read):
+            for cube in (refl, qa, vza, sza, raa):
+                cube[j] = 0
+        data = {}
+        data['sza'] = sza
+        data['vza'] = vza
+        data['raa'] = raa
+        data['refl'] = refl
+        data['qa'] = qa
+        data['date'] = dates
+        data['file'] = np.array([self.store] * len(dates))
+        data['read'] = read
+        data['missing'] = missing
+        data['failed'] = failed
+        return data
+
+    def read_files(self):
+        """
+        Reads the chunk from the daily gridded files, unscreened
+
+        data['missing'] lists the days with no file and
+        data['failed'] maps the date of each file that could not be
+        read to the error, the same as read_store gives.
+        """
         # cba re-writing...
         tile = self.tile
         xmin = self.xmin
@@ -71,80 +493,31 @@ class OLCI_refl(object):
         ending = self.end_date
         # figure what dates we need
         ndays = (ending - beginning).days
-        dates = np.array(
-            [beginning + datetime.timedelta(days=x) for x in range(0, ndays)])
-        the_files = np.array(glob.glob(self.datadir + "*.tif"))
-        the_files.sort()
-        file_mtnh = [
-            int(f.split("_")[-1].strip(".tif")[4:6]) for f in the_files
-        ]
-        file_day = [int(f.split("_")[-1].strip(".tif")[6:]) for f in the_files]
-        file_years = [
-            int(f.split("_")[-1].strip(".tif")[:4]) for f in the_files
-        ]
-        dates = np.array([
-            datetime.datetime(yr, mt, dy)
-            for yr, mt, dy in zip(file_years, file_mtnh, file_day)
-        ])
-        # limit files by dates
-        keep = np.logical_and(dates >= self.start_date, dates < self.end_date)
-        the_files = the_files[keep]
-        dates = dates[keep]
-        idx = np.array([(d - self.start_date).days for d in dates])
+        # files in the date range from the tile's catalogue
+        files = find_files(self.datadir, self.start_date, self.end_date)
+        dates = np.array([d for d, f in files])
+        the_files = np.array([f for d, f in files])
+        idx = np.array([(d - self.start_date).days for d in dates], dtype=int)
         """
         make storage for the data
         """
-        refl = np.zeros((ndays, 4, ys, xs))
-        qa = np.zeros((ndays, ys, xs))
-        sza = np.zeros((ndays, ys, xs))
-        vza = np.zeros((ndays, ys, xs))
-        raa = np.zeros((ndays, ys, xs))
-        # loop over the files and load the data
-        for f, j in zip(the_files, idx):
-            try:
-                data = self.load_file(f)
-                # we know what each band is quite easily
-                _Oa03, _Oa06, _Oa08, _Oa18, _qa, _vza, _sza, _raa = data
-                _qa = _qa.astype(np.bool)
-
-                """
-                calculate NDVI for rudimentary snow mask
-                """
-                NDVI = (_Oa18-_Oa08)/(_Oa18+_Oa08)
-                snow = NDVI<=0
-                _qa = np.logical_and(_qa, ~snow)
-                # new-qa as some bands have different qa
-                # e.g. B03 seems to have a better qa
-                # true is good
-                band_b03 = _Oa03<=0
-                _qa = np.logical_and(_qa, ~band_b03)
-                # sometimes
-                # save these...
-                refl[j] = (_Oa03, _Oa06, _Oa08, _Oa18)
-                refl[j][:, ~_qa]=-1e04
-                qa[j] = _qa
-                sza[j] = _sza
-                vza[j] = _vza
-                raa[j] = _raa
-            except:
-                pass
-        """
-        compute the kernels for the angles
-        """
-        kerns = Kernels(
-            vza,
-            sza, (raa),
-            LiType='Sparse',
-            doIntegrals=False,
-            normalise=True,
-            RecipFlag=True,
-            RossHS=False,
-            MODISSPARSE=True,
-            RossType='Thick',
-            nbar=0.0)
-        kerns.Ross = kerns.Ross.reshape((ndays, ys, xs))
-        kerns.Li = kerns.Li.reshape((ndays, ys, xs))
-        kerns.Isotropic = kerns.Isotropic.reshape((ndays, ys, xs))
+        refl, qa, vza, sza, raa = self.allocate(ndays, ys, xs)
+        # read the files on a thread pool straight into the cubes
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            errors = list(pool.map(
+                lambda fj: self._load_day(*fj, refl, qa, vza, sza, raa),
+                zip(the_files, idx)))
+        failed = {d: f"{f}: {e}" for d, f, e in zip(dates, the_files, errors)
+                  if e is not None}
+        read = np.zeros(ndays, dtype=bool)
+        read[[j for j, e in zip(idx, errors) if e is None]] = True
+        for e in failed.values():
+            LOG.warning(f"could not read {e}")
+        missing = sorted(set(range(ndays)) - set(idx.tolist()))
+        missing = [beginning + datetime.timedelta(days=int(d)) for d in missing]
+        if missing or failed:
+            LOG.warning(f"{tile}: {len(missing)} of {ndays} days have no file "
+                        f"and {len(failed)} files could not be read")
         """
         make everything into a dictionary to be similar across
         sensors
@@ -155,9 +528,119 @@ class OLCI_refl(object):
         data['raa'] = raa
         data['refl'] = refl
         data['qa'] = qa
-        data['kernels'] = kerns
         data['date'] = dates
-        self.data = data
+        data['file'] = the_files
+        data['read'] = read
+        data['missing'] = missing
+        data['failed'] = failed
+        return data
+
+
+def pixel_blocks(rows, cols, block):
+    """
+    Groups pixels by the (block, block) tile of the raster they are in
+
+    Returns (r0, r1, c0, c1, idx) for each tile with pixels in it --
+    the bounding box of its pixels and which pixels they are.
+    """
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    key = (rows // block[0]) * (1 << 20) + cols // block[1]
+    groups = []
+    for k in np.unique(key):
+        idx = np.nonzero(key == k)[0]
+        groups.append((rows[idx].min(), rows[idx].max() + 1,
+                       cols[idx].min(), cols[idx].max() + 1, idx))
+    return groups
+
+
+class OLCI_pixels(OLCI_refl):
+    """
+    OLCI_refl for a scattered set of pixels rather than a window
+
+    Only the file (or store) tiles the pixels fall in are read, so
+    the cost goes with the number of pixels not the area around
+    them. data is laid out as for OLCI_refl with the pixels as a
+    (1, npix) window, eg refl is (ndays, 4, 1, npix).
+    """
+
+    def __init__(self, tile, start_date, end_date, rows, cols, **kwargs):
+        self.rows = np.asarray(rows, dtype=int)
+        self.cols = np.asarray(cols, dtype=int)
+        super().__init__(tile, start_date, end_date, 0, 0, len(self.rows), 1,
+                         **kwargs)
+
+    @classmethod
+    def from_lonlat(cls, tile, start_date, end_date, lons, lats, **kwargs):
+        """
+        Pixels at lon/lat (degrees) found with the grid of the tile's files
+
+        Raises ValueError if the tile has no files in the date range
+        or any of the points are outside the tile.
+        """
+        o = cls(tile, start_date, end_date, [], [], **kwargs)
+        files = find_files(o.datadir, start_date, end_date)
+        if not files:
+            raise ValueError(f"{tile}: no files in {o.datadir} from "
+                             f"{start_date:%Y-%m-%d} to {end_date:%Y-%m-%d}")
+        with rasterio.open(files[0][1]) as src:
+            x, y = rasterio.warp.transform('EPSG:4326', src.crs, lons, lats)
+            gt = src.transform
+            height, width = src.height, src.width
+        # the MODIS grid is north up
+        cols = np.floor((np.asarray(x) - gt.c) / gt.a).astype(int)
+        rows = np.floor((np.asarray(y) - gt.f) / gt.e).astype(int)
+        outside = (rows < 0) | (rows >= height) | (cols < 0) | (cols >= width)
+        if outside.any():
+            bad = np.flatnonzero(outside)
+            lonlat = [(np.ravel(lons)[i], np.ravel(lats)[i]) for i in bad[:5]]
+            raise ValueError(f"{tile}: {len(bad)} of {outside.size} points are "
+                             f"outside the tile eg (lon, lat) {lonlat}")
+        return cls(tile, start_date, end_date, rows, cols, **kwargs)
+
+    def mask_file(self):
+        """
+        Where the reasons bitmask of these pixels is cached
+        """
+        key = hashlib.md5(np.stack([self.rows, self.cols]).tobytes()).hexdigest()
+        return os.path.join(
+            self.mask_cache,
+            f"{self.tile}_{self.start_date:%Y%m%d}_{self.end_date:%Y%m%d}_"
+            f"pixels_{key[:16]}.npz")
+
+    def _gather(self, read, block, nlead):
+        """
+        (..., 1, npix) array of the pixels from read(r0, r1, c0, c1)
+        of each tile they are in
+        """
+        out = None
+        for r0, r1, c0, c1, idx in pixel_blocks(self.rows, self.cols, block):
+            a = read(r0, r1, c0, c1)
+            if out is None:
+                out = np.zeros(a.shape[:nlead] + (1, len(self.rows)), dtype=a.dtype)
+            out[..., 0, idx] = a[..., self.rows[idx] - r0, self.cols[idx] - c0]
+        return out
+
+    def _read(self, src, indexes, out=None):
+        block = src.block_shapes[0]
+        nlead = 1 if np.ndim(indexes) else 0
+        a = self._gather(lambda r0, r1, c0, c1: src.read(
+            indexes, window=Window(c0, r0, c1 - c0, r1 - r0)), block, nlead)
+        if out is None:
+            return a
+        out[...] = a
+        return out
+
+    def _store_blocks(self, chunk):
+        blocks = np.unique(np.stack([self.rows // chunk, self.cols // chunk]),
+                           axis=1)
+        return blocks[0], blocks[1]
+
+    def _store_read(self, nc, name, s0, s1):
+        var = nc[name]
+        nlead = var.ndim - 2
+        return self._gather(lambda r0, r1, c0, c1: var[s0:s1, ..., r0:r1, c0:c1],
+                            (nc.chunk, nc.chunk), nlead)
 
 
 if __name__ == "__main__":
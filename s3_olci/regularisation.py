@@ -1,27 +1,25 @@
+"""
+regularisation.py
+Edge preserving temporal regularisation of reflectance time series
+
+Kept light to import as it is loaded by every pool worker --
+only numpy and numba are needed to solve. The numba kernels
+are cached to disk so they are only compiled once.
+"""
+import logging
 import numpy as np
-from kernels import *
-import scipy.linalg
-import glob
-import datetime
 import numba as nb
-import matplotlib.pyplot as plt
-import time
-np.seterr(all='ignore')
-import scipy.sparse as sp
-import scipy.sparse.linalg as sl
-import bandmat as bm  # nice package!
-import scipy.stats
-import scipy.ndimage
-from scipy.fftpack import fft, fftshift
-import scipy.signal
 
+LOG = logging.getLogger(__name__)
 
 MODIS_C_obs = np.array([0.004, 0.015, 0.003, 0.004, 0.013, 0.010, 0.006])**2
 OLCI_C_obs = np.array([0.004, 0.003, 0.004, 0.015])**2
 
+# everything is float32 unless float64 is asked for
+DTYPE = np.float32
 
 
-@nb.njit
+@nb.njit(cache=True)
 def prepare_iso(doy, iso, nT):
     # Get a optimal 1 ob per day record...
     # not ideal of course...
@@ -38,7 +36,7 @@ def prepare_iso(doy, iso, nT):
             iso_ret[idoy, band] = r
     return iso_ret
 
-def prepare_mats(refl, alpha=1e3):
+def prepare_mats(refl, alpha=1e3, dtype=DTYPE):
     """
     Does some prep to produce matrices for the TDMA
     """
@@ -46,25 +44,15 @@ def prepare_mats(refl, alpha=1e3):
     Iobs = y > 0
     nT, ys, xs = y.shape
     # Create mats
-    AC, BC, CC, DC = [  np.zeros([nT-1, ys, xs], dtype=np.float32),
-                        np.zeros([nT, ys, xs], dtype=np.float32),
-                        np.zeros([nT-1, ys, xs],  dtype=np.float32),
-                        np.zeros([nT, ys, xs],  dtype=np.float32)]
-    # Create Diagonals matrices
-    # for ease just use bandmat for this for now
-    # Form diagonals
-    I = np.eye(nT)  #np.diag (np.ones(nx))
-    D = (I - np.roll(I, -1)).T
-    #D = D.T.dot(D)
-    D1A = np.zeros((nT, 2))
-    D1A[1:, 0] = np.diag(D, 1)
-    D1A[:, 1] = np.diag(D, 0)
-    # convert to banded matrices
-    D = bm.BandMat(0, 1, D1A.T, transposed=False)
-    D2 = bm.dot_mm(D.T, D)
-    a = alpha * D2.data[2][:-1]
-    b = alpha * D2.data[1]
-    c = alpha * D2.data[0][1:]
+    AC, BC, CC, DC = [  np.zeros([nT-1, ys, xs], dtype=dtype),
+                        np.zeros([nT, ys, xs], dtype=dtype),
+                        np.zeros([nT-1, ys, xs],  dtype=dtype),
+                        np.zeros([nT, ys, xs],  dtype=dtype)]
+    # Diagonals of D.T D for the first difference operator
+    # (see penalty_mats with all the weights 1)
+    a = -alpha * np.ones(nT-1)
+    b = alpha * np.r_[1., 2 * np.ones(nT-2), 1.]
+    c = -alpha * np.ones(nT-1)
     # add these
     AC[:]=a[:, None, None]
     BC[:]=b[:, None, None]+ Iobs
@@ -73,7 +61,44 @@ def prepare_mats(refl, alpha=1e3):
     return AC, BC, CC, DC
 
 
-def TDMA_MAT(A_, B_, C_, D_):
+TDMA_BLOCK = 256
+
+
+@nb.njit(parallel=True, cache=True)
+def _tdma_kernel(A, B, C, D, X, block):
+    """
+    Thomas algorithm on (nT, npix) arrays
+
+    Pixels are split into blocks of contiguous columns that
+    are solved in parallel. Within a block the sweeps over
+    time run along rows so memory access stays contiguous.
+    Only the modified diagonal for a block is allocated,
+    D may be the same array as X to solve in place.
+    """
+    nT, npix = D.shape
+    nblk = (npix + block - 1) // block
+    for ib in nb.prange(nblk):
+        x0 = ib * block
+        x1 = min(x0 + block, npix)
+        BP = np.empty((nT, x1 - x0), dtype=B.dtype)
+        for j in range(x1 - x0):
+            BP[0, j] = B[0, x0 + j]
+            X[0, x0 + j] = D[0, x0 + j]
+        for it in range(1, nT):
+            for j in range(x1 - x0):
+                x = x0 + j
+                m = A[it-1, x] / BP[it-1, j]
+                BP[it, j] = B[it, x] - m * C[it-1, x]
+                X[it, x] = D[it, x] - m * X[it-1, x]
+        for j in range(x1 - x0):
+            X[nT-1, x0 + j] = X[nT-1, x0 + j] / BP[nT-1, j]
+        for il in range(nT-2, -1, -1):
+            for j in range(x1 - x0):
+                x = x0 + j
+                X[il, x] = (X[il, x] - C[il, x] * X[il+1, x]) / BP[il, j]
+
+
+def TDMA_MAT(A_, B_, C_, D_, out=None):
     """
     Thomas algorithm for a matrix
     Arguments need to be supplied correctly
@@ -83,13 +108,103 @@ def TDMA_MAT(A_, B_, C_, D_):
     BC -- matrix for the middle diagonals
     CC -- matrix of the upper diagonals
     DD -- matrix of the RHS
+    out -- optional array to write the solution to
+           (can be D_ itself to solve in place)
+
+    Works on any (nT, ...) shape. The solution has the
+    dtype of BC as before so float32 stays float32.
+    Inputs are not modified unless out is D_.
+    """
+    nT = D_.shape[0]
+    if out is None:
+        out = np.empty(D_.shape, dtype=B_.dtype)
+    X = out.reshape((nT, -1))
+    if not np.may_share_memory(X, out):
+        raise ValueError("out must be contiguous to be solved in place")
+    _tdma_kernel(A_.reshape((nT-1, -1)), B_.reshape((nT, -1)),
+                 C_.reshape((nT-1, -1)), D_.reshape((nT, -1)),
+                 X, TDMA_BLOCK)
+    return out
+
+
+@nb.njit(parallel=True, cache=True)
+def _tdma_inv_kernel(A, B, C, V, U, offdiag, block):
+    """
+    Diagonal (and first upper diagonal) of the inverse of
+    tridiagonal systems on (nT, npix) arrays.
+
+    With forward pivots d_t and backward pivots e_t
+        inv[t, t]   = 1 / (d_t + e_t - b_t)
+        inv[t, t+1] = -c_t inv[t+1, t+1] / d_t
+    Pivots are kept in float64 as the diagonal is a
+    difference of large numbers.
+    """
+    nT, npix = B.shape
+    nblk = (npix + block - 1) // block
+    for ib in nb.prange(nblk):
+        x0 = ib * block
+        x1 = min(x0 + block, npix)
+        DP = np.empty((nT, x1 - x0))
+        EP = np.empty(x1 - x0)
+        for j in range(x1 - x0):
+            DP[0, j] = B[0, x0 + j]
+        for it in range(1, nT):
+            for j in range(x1 - x0):
+                x = x0 + j
+                DP[it, j] = B[it, x] - np.float64(A[it-1, x]) * C[it-1, x] / DP[it-1, j]
+        for j in range(x1 - x0):
+            x = x0 + j
+            EP[j] = B[nT-1, x]
+            V[nT-1, x] = 1. / DP[nT-1, j]
+        for il in range(nT-2, -1, -1):
+            for j in range(x1 - x0):
+                x = x0 + j
+                EP[j] = B[il, x] - np.float64(A[il, x]) * C[il, x] / EP[j]
+                V[il, x] = 1. / (DP[il, j] + EP[j] - B[il, x])
+                if offdiag:
+                    U[il, x] = -C[il, x] * np.float64(V[il+1, x]) / DP[il, j]
+
+
+def TDMA_INV(A_, B_, C_, offdiag=False):
+    """
+    Posterior variance from the tridiagonal system
+    ie the diagonal of inv(M) without forming it
+
+    Replaces solving with a unit RHS for each time step
+    so it is O(nT) per pixel and covers all time steps.
+
+    AC -- matrix for the lower diagonals
+    BC -- matrix for the middle diagonals
+    CC -- matrix of the upper diagonals
+    offdiag -- also return the first off-diagonal of
+               inv(M) eg covariance between t and t+1
+
+    Returns (nT, ...) variances with the dtype of BC
+    and if offdiag an (nT-1, ...) array of covariances
+    """
+    nT = B_.shape[0]
+    V = np.empty(B_.shape, dtype=B_.dtype)
+    U = np.zeros((nT-1,) + B_.shape[1:], dtype=B_.dtype)
+    _tdma_inv_kernel(A_.reshape((nT-1, -1)), B_.reshape((nT, -1)),
+                     C_.reshape((nT-1, -1)), V.reshape((nT, -1)),
+                     U.reshape((nT-1, -1)), offdiag, TDMA_BLOCK)
+    if offdiag:
+        return V, U
+    return V
+
+
+@np.errstate(all='ignore')
+def TDMA_MAT_numpy(A_, B_, C_, D_):
+    """
+    Original numpy version of TDMA_MAT
+    kept for checking the compiled one against
     """
     # these two get over-written
     DC = np.copy(D_)
     BC = np.copy(B_)
     AC = np.copy(A_)
     CC = np.copy(C_)
-    nT, ys, xs = DC.shape
+    nT = DC.shape[0]
     for it in range(1, nT):
         MC = AC[it-1]/(BC[it-1])
         BC[it] = (BC[it]) - MC*CC[it-1]
@@ -101,186 +216,259 @@ def TDMA_MAT(A_, B_, C_, D_):
     return XC
 
 
-def retrieve_along_axis(ys, xs, refl, IDX, PRES, POSTS):
+def penalty_mats(W, Iobs, alpha, A, B, C, mask=None):
+    """
+    Fills the diagonals of alpha * D.T W D + diag(Iobs) for a whole
+    (nT, ys, xs) block at once.
+
+    D is the first difference operator (rows x_t - x_t+1) so the product
+    is tridiagonal in closed form:
+        lower/upper  -alpha * w_t              t = 0..nT-2
+        middle        alpha * (w_t + w_t-1)    with one term at each end
+    which is the same as the per-pixel bm.dot_mm(_D.T, _D, diag=w)
+
+    W     -- (nT, ys, xs) weights
+    Iobs  -- (nT, ys, xs) observation mask
+    A,B,C -- matrices from prepare_mats, updated in place
+    mask  -- (ys, xs) only update these pixels eg unconverged
+
+    Done in the dtype of A so float32 stays float32
+    """
+    alpha = A.dtype.type(alpha)
+    w = W[:-1].astype(A.dtype)
+    b = np.zeros(W.shape, dtype=A.dtype)
+    b[:-1] += w
+    b[1:] += w
+    b *= alpha
+    b += Iobs
+    w *= -alpha
+    if mask is None:
+        A[:] = w
+        B[:] = b
+        C[:] = w
+    else:
+        np.copyto(A, w, where=mask[None])
+        np.copyto(B, b, where=mask[None])
+        np.copyto(C, w, where=mask[None])
+    return A, B, C
+
+
+def penalty_mats_bandmat(W, Iobs, alpha, A, B, C):
+    """
+    The original per-pixel bandmat version of penalty_mats
+
+    Very slow -- kept to check the closed form against
+    """
+    import bandmat as bm
+    nT, ys, xs = W.shape
+    I = np.eye(nT)
+    D = (I - np.roll(I, -1)).T
+    D1A = np.zeros((nT, 2))
+    D1A[1:, 0] = np.diag(D, 1)
+    D1A[:, 1] = np.diag(D, 0)
+    _D = bm.BandMat(0, 1, D1A.T, transposed=False)
     for y in range(ys):
         for x in range(xs):
-            # this is wrong still
-            idx = IDX[y, x]
-            # clip it
-            idx = np.clip(idx, 30, 60)
-            pre = refl[:, y, x][idx-16:idx]
-            post = refl[:, y, x][idx+1:idx+17]
-            # step check
-            PRES[:, y,x]=pre
-            POSTS[:, y,x]=post
+            n = alpha * bm.dot_mm(_D.T, _D, diag=W[:, y, x].astype(np.float64))
+            A[:, y, x] = n.data[2][:-1]
+            B[:, y, x] = n.data[1] + Iobs[:, y, x]
+            C[:, y, x] = n.data[0][1:]
+    return A, B, C
+
+
+def retrieve_along_axis(refl, IDX, window=16):
+    """
+    Pulls out the window obs before and after IDX
+    for every pixel at once
+
+    refl -- (nT, ys, xs)
+    IDX  -- (ys, xs) time index of the edge
+
+    Returns PRES, POSTS of (window, ys, xs)
+    """
+    pre = np.arange(-window, 0)[:, None, None]
+    post = np.arange(1, window + 1)[:, None, None]
+    PRES = np.take_along_axis(refl, IDX[None] + pre, axis=0)
+    POSTS = np.take_along_axis(refl, IDX[None] + post, axis=0)
+    return PRES, POSTS
+
+
+def nanmedian0(a):
+    """
+    Median over the first axis ignoring nans
+
+    Same as np.nanmedian(a, axis=0) but done with
+    one sort rather than masking each pixel
+    """
+    n = (~np.isnan(a)).sum(axis=0)
+    # nans get sorted to the end
+    srt = np.sort(a, axis=0)
+    lo = np.take_along_axis(srt, np.maximum(n - 1, 0)[None] // 2, axis=0)[0]
+    hi = np.take_along_axis(srt, np.minimum(n, a.shape[0] - 1)[None] // 2, axis=0)[0]
+    med = (lo + hi) / 2
+    med[n == 0] = np.nan
+    return med
 
 
 #@numba.njit
-def refine_edges(W, X,refl):
+@np.errstate(all='ignore')
+def refine_edges(W, X,refl, window=16, search=(30, 60)):
     """
     This updates the edges W to stengthen drops etc
+
+    window -- number of obs either side of the edge for the step test
+    search -- (first, last) time step to look for the edge in.
+              Clipped so the windows fit in the time series.
     """
     nT, ys, xs= X.shape
-    PRES = np.zeros((16, ys, xs))
-    POSTS = np.zeros((16, ys, xs))
-    IDX = np.nanargmin(W[30:61], axis=0)
-    IDX+=30
+    lo = max(search[0], window)
+    hi = min(search[1], nT - window - 1)
+    if lo > hi:
+        # too short to test for a step
+        return W, np.zeros((ys, xs), dtype=bool), np.zeros((ys, xs), dtype=refl.dtype)
+    IDX = np.nanargmin(W[lo:hi+1], axis=0)
+    IDX+=lo
     # fill these matrices
-    retrieve_along_axis(ys, xs, refl, IDX, PRES, POSTS)
+    PRES, POSTS = retrieve_along_axis(refl, IDX, window)
     PRES[PRES==0]=np.nan
     POSTS[POSTS==0]=np.nan
     """
     do the MAD test
     """
-    dch = np.nanmedian(POSTS, axis=0) - np.nanmedian(PRES, axis=0)
-    preMAD = 1.426 * np.nanmedian((np.abs(np.nanmedian(PRES, axis=0)-PRES)), axis=0)
-    postMAD = 1.426 * np.nanmedian((np.abs(np.nanmedian(POSTS, axis=0)-POSTS)), axis=0)
+    preMed = nanmedian0(PRES)
+    postMed = nanmedian0(POSTS)
+    dch = postMed - preMed
+    preMAD = 1.426 * nanmedian0(np.abs(preMed-PRES))
+    postMAD = 1.426 * nanmedian0(np.abs(postMed-POSTS))
     # make robust Z SCORE
     Sch =  np.abs(dch/(preMAD + postMAD))
-    # check we actually have some obs for this
+    # check we actually have some obs for this
     COND = np.logical_and((PRES>0).sum(axis=0)>3, (POSTS>0).sum(axis=0)>3)
     KeepEdges=COND
-    for y in range(ys):
-        for x in range(xs):
-            idx = IDX[y,x]
-            if Sch[y,x]>1 and COND[y,x]:
-                """
-                So this is probably a step
-                fix it up a bit
-                """
-                W[:, y, x] = 1
-                W[:, y, x][idx] = 0.01
-            # and if the COND is not met remove the step
-            if not COND[y,x]:
-                pass
-                #W[:, y,x]=1
-                #Sch[y,x]=0
+    """
+    So where this is probably a step
+    fix it up a bit
+    """
+    step = np.logical_and(Sch>1, COND)
+    sy, sx = np.nonzero(step)
+    W[:, sy, sx] = 1
+    W[IDX[sy, sx], sy, sx] = 0.01
     return W, KeepEdges, Sch
 
 
-def solve_band(refl, solve_edge=True, W=None, alpha=1000, unc=False, drop=True):
+@np.errstate(all='ignore')
+def irls_weights(X, nObs, alpha, T, drop=True):
+    """
+    Edge preserving weights from the current solution
+
+    Works on (nT, ...) blocks so can be run on
+    just a subset of pixels. Stays in the dtype of X.
+    """
+    dtype = X.dtype.type
+    # calculate weights
+    #dx = np.diff(X, axis=0, n=order_n)* alpha**2
+    dx = np.gradient(X, axis=0) * dtype(alpha**2)
+    # enforce direction constraint
+    if drop != None:
+        if drop:
+            dx[dx>0]=0
+        else:
+            dx[dx<=0]=0
+    # eg frst 30 days and last 30 days
+    _w = np.exp(-dx**2 / dtype(T))
+    """
+    Scaling from CERC
+    """
+    wScale = nObs.astype(dtype) / np.sum(_w, axis=0)
+    _w = _w * wScale
+    _w = np.clip(_w, 0., 1)
+    np.place(_w, np.isnan(_w), 1)
+    return _w
+
+
+@np.errstate(all='ignore')
+def solve_band(refl, solve_edge=True, W=None, alpha=1000, unc=False, drop=True,
+               active_set=False, dtype=DTYPE, window=16, search=(30, 60),
+               nobs_mean=None):
     """
     test run function
+
+    active_set -- only re-solve pixels that haven't converged
+                  each IRLS iteration. These are packed into a dense
+                  (nT, nActive) batch and scattered back. Gives the
+                  same answer as solving the whole tile.
+    dtype      -- float type everything is solved in
+    window, search -- step test settings passed to refine_edges
+    nobs_mean  -- mean number of obs alpha is scaled by, defaults
+                  to this chunk's. Lets a subset of pixels be solved
+                  as they would be in the whole chunk.
     """
     Iobs = (refl>0)
     nObs = (Iobs).sum(axis=0)
+    if nobs_mean is None:
+        nobs_mean = np.nanmean(nObs)
     # scale alpha
     alpha = 1
-    alpha = alpha * np.nanmean(nObs)
+    alpha = alpha * nobs_mean
     alpha = np.clip(alpha, 20, 250)
     if solve_edge:
         T = .6 * alpha
         nT, ys, xs = refl.shape
-        # make D matrix
-        I = np.eye(nT)  #np.diag (np.ones(nx))
-        D = (I - np.roll(I, -1)).T
-        #D = D.T.dot(D)
-        D1A = np.zeros((nT, 2))
-        D1A[1:, 0] = np.diag(D, 1)
-        D1A[:, 1] = np.diag(D, 0)
-        # convert to banded matrices
-        _D = bm.BandMat(0, 1, D1A.T, transposed=False)
         # create mats
-        A, B, C, D = prepare_mats(refl, alpha=alpha)
+        A, B, C, D = prepare_mats(refl, alpha=alpha, dtype=dtype)
         # Initial run with no smoothing
         X = TDMA_MAT(A, B, C, D)
         W0 = np.ones_like(X)*100
         WW = np.ones_like(X)
         X0 = np.zeros_like(D)
-        CONV = np.zeros((ys, xs)).astype(np.bool)
-        Nits =  np.zeros((ys, xs), dtype=np.int)
-        for i in range(5):
-            # calculate weights
-            order_n = 1
-            #dx = np.diff(X, axis=0, n=order_n)* alpha**2
-            dx = np.gradient(X, axis=0) * alpha**2
-            # enforce direction constraint
-            if drop != None:
-                if drop:
-                    dx[dx>0]=0
-                else:
-                    dx[dx<=0]=0
-            # eg frst 30 days and last 30 days
-            _w = np.exp(-dx**2 / T)
-            """
-            Scaling from CERC
-            """
-            y,x=30, 57
-            wScale = nObs / np.sum(_w, axis=0)
-            _w = _w * wScale
-            _w = np.clip(_w, 0., 1)
-            np.place(_w, np.isnan(_w), 1)
-            WW[:]=_w
-            """
-            Update the regularisation matrix
-            with the weights
-
-            -- This involves a dot product
-            with a diag eg D.T W D
-                so i don't how to do this atm
-
-            This is the slowest so if this can be done fast much better
-            """
-            for y in range(ys):
-                for x in range(xs):
-                    if not CONV[y,x]:
-                        # no convergence keep going
-                        n = alpha * bm.dot_mm(_D.T, _D, diag=WW[:, y, x].astype(np.float))
-                        a = n.data[2][:-1]
-                        b = n.data[1]  + Iobs[:, y, x]
-                        c = n.data[0][1:]
-                        # update matrices
-                        A[:, y, x]=a
-                        B[:, y, x]=b
-                        C[:, y, x]=c
-                        Nits[y,x]+=1
-            """
-            Run again with new weights
-            """
-            X = TDMA_MAT(A, B, C, D)
-            """
-            assess convergence
-            -eg are the weights still changing
-            """
-            cow = np.sum(np.abs((WW - W0) / W0), axis=0)+ 1e-6
-            CONV[cow<1e-2]=True
-            MINITER=3
-            if i< MINITER:
-                CONV[:]=False
-            CONV[WW.min(axis=0)<0.1]=True
-            W0 = WW
-            X0 = X
+        CONV = np.zeros((ys, xs)).astype(bool)
+        Nits =  np.zeros((ys, xs), dtype=int)
+        MINITER=3
+        if active_set:
+            X, WW = _solve_band_active(A, D, Iobs, nObs, X, W0, WW, CONV,
+                                       Nits, alpha, T, drop, MINITER)
+        else:
+            for i in range(5):
+                WW[:] = irls_weights(X, nObs, alpha, T, drop)
+                """
+                Update the regularisation matrix
+                with the weights eg D.T W D
+                -- only for pixels that haven't converged
+                """
+                penalty_mats(WW, Iobs, alpha, A, B, C, mask=~CONV)
+                Nits[~CONV] += 1
+                """
+                Run again with new weights
+                """
+                X = TDMA_MAT(A, B, C, D)
+                """
+                assess convergence
+                -eg are the weights still changing
+                """
+                cow = np.sum(np.abs((WW - W0) / W0), axis=0)+ 1e-6
+                CONV[cow<1e-2]=True
+                if i< MINITER:
+                    CONV[:]=False
+                CONV[WW.min(axis=0)<0.1]=True
+                W0 = WW
+                X0 = X
         """
         Want to check steps and re-inforce real steps
         """
-        W, keptEdges, Sch = refine_edges(WW, X, refl)
+        W, keptEdges, Sch = refine_edges(WW, X, refl, window=window,
+                                         search=search)
         """
         Resolve with refined edges
         """
-        for y in range(ys):
-            for x in range(xs):
-                    n = alpha * bm.dot_mm(_D.T, _D, diag=W[:, y, x].astype(np.float))
-                    a = n.data[2][:-1]
-                    b = n.data[1]  + Iobs[:, y, x]
-                    c = n.data[0][1:]
-                    # update matrices
-                    A[:, y, x]=a
-                    B[:, y, x]=b
-                    C[:, y, x]=c
-                    Nits[y,x]+=1
+        penalty_mats(W, Iobs, alpha, A, B, C)
+        Nits += 1
         """
         Run again with the refined weights
         """
         #y,x=43, 62
         if unc:
             X = TDMA_MAT(A, B, C, D)
-            DD = np.copy(D).astype(np.float32)
-            Inv = np.zeros_like(X)
-            # only need the middle month tbh
-            for t in range(20, nT-20):
-                DD[:]=0
-                DD[t]=1
-                Inv[t]=TDMA_MAT(A, B, C, DD)[t]
+            Inv = TDMA_INV(A, B, C)
             return X, Inv, W, CONV, Nits, Sch
         else:
             X = TDMA_MAT(A, B, C, D)
@@ -292,28 +480,10 @@ def solve_band(refl, solve_edge=True, W=None, alpha=1000, unc=False, drop=True):
         Iobs = (refl>0)
         nObs = (Iobs).sum(axis=0)
         nT, ys, xs = refl.shape
-        # make D matrix
-        I = np.eye(nT)  #np.diag (np.ones(nx))
-        D = (I - np.roll(I, -1)).T
-        #D = D.T.dot(D)
-        D1A = np.zeros((nT, 2))
-        D1A[1:, 0] = np.diag(D, 1)
-        D1A[:, 1] = np.diag(D, 0)
-        # convert to banded matrices
-        _D = bm.BandMat(0, 1, D1A.T, transposed=False)
         # create mats
-        A, B, C, D = prepare_mats(refl, alpha=alpha)
-        # add the weights matrix
-        for y in range(ys):
-            for x in range(xs):
-                n = alpha * bm.dot_mm(_D.T, _D, diag=W[:, y, x].astype(np.float))
-                a = n.data[2][:-1]
-                b = n.data[1]  + Iobs[:, y, x]
-                c = n.data[0][1:]
-                # update matrices
-                A[:, y, x]=a
-                B[:, y, x]=b
-                C[:, y, x]=c
+        A, B, C, D = prepare_mats(refl, alpha=alpha, dtype=dtype)
+        # add the weights matrix
+        penalty_mats(W, Iobs, alpha, A, B, C)
         """
         Run again with the refined weights
         """
@@ -321,51 +491,258 @@ def solve_band(refl, solve_edge=True, W=None, alpha=1000, unc=False, drop=True):
         return X, W
 
 
-def edge_preserving(sensor, refl, band_rmse=None):
+@np.errstate(all='ignore')
+def solve_band_warm(refl, W_prev, X_prev, margin=30, niter=2, drop=True,
+                    dtype=DTYPE, window=16, search=30):
+    """
+    Warm started solve_band for a window that has moved on in time
+
+    W_prev, X_prev -- (nOld, ys, xs) weights and solution from the
+                      previous run for the first nOld dates of refl
+    margin -- days before the new ones that get re-solved too
+    niter  -- IRLS iterations, not many needed as the weights
+              are seeded from the previous run
+    window, search -- the step test on the tail uses window obs
+              either side of an edge and needs search days to look
+              for it in. margin is raised so the tail is at least
+              2 * window + 1 + search days -- refine_edges can't test
+              anything in a tail shorter than 2 * window + 1.
+
+    The first nOld - margin days are held at the previous solution
+    and only the tail is solved, tied in to the last held day.
+    Edges in the held days come from the previous run and the step
+    test is only run on the tail.
+
+    Returns X, W for the whole window
+    """
+    nT, ys, xs = refl.shape
+    nOld = W_prev.shape[0]
+    Iobs = (refl>0)
+    nObs = (Iobs).sum(axis=0)
+    # scale alpha as in solve_band -- over the whole window
+    alpha = np.clip(np.nanmean(nObs), 20, 250)
+    T = .6 * alpha
+    tail = max(nT - nOld + margin, 2 * window + 1 + search)
+    # need at least one held day to tie the tail to
+    t0 = min(max(nT - tail, 1), nT - 1)
+    X = np.empty((nT, ys, xs), dtype=dtype)
+    W = np.ones((nT, ys, xs), dtype=dtype)
+    X[:nOld] = X_prev
+    W[:nOld] = W_prev
+    # persistence as the first guess for the new days
+    X[nOld:] = X_prev[-1]
+    A, B, C, D = prepare_mats(refl[t0:], alpha=alpha, dtype=dtype)
+    for i in range(niter + 1):
+        if i > 0:
+            W[t0-1:] = irls_weights(X, nObs, alpha, T, drop)[t0-1:]
+        _solve_tail(A, B, C, D, W, X, Iobs, alpha, t0)
+    """
+    Check steps in the tail and resolve
+    """
+    refine_edges(W[t0:], X[t0:], refl[t0:], window=window,
+                 search=(0, nT - t0))
+    _solve_tail(A, B, C, D, W, X, Iobs, alpha, t0)
+    return X, W
+
+
+def _solve_tail(A, B, C, D, W, X, Iobs, alpha, t0):
+    """
+    Solves X[t0:] with X[:t0] held fixed
+
+    The held X[t0-1] only enters the first row of the
+    tail system through its weight W[t0-1]
     """
+    penalty_mats(W[t0:], Iobs[t0:], alpha, A, B, C)
+    wb = alpha * W[t0-1]
+    B[0] += wb
+    DD = np.copy(D)
+    DD[0] += wb * X[t0-1]
+    X[t0:] = TDMA_MAT(A, B, C, DD, out=DD)
+
 
+@np.errstate(all='ignore')
+def solve_bands(refl, W, dtype=DTYPE, nobs_mean=None, nbands=None):
+    """
+    solve_band with a given edge W for all bands at once
+
+    The left hand sides only differ by each band's alpha
+    and Iobs so D.T W D is formed once and the bands are
+    solved together as one (nT, nBands, ys, xs) system.
+
+    Returns X with the same values as calling
+    solve_band(refl[:, band], solve_edge=False, W=W)
+    for each band. nobs_mean is each band's nobs_mean for solve_band.
+    Only the first nbands bands are solved if given. refl is read a
+    band at a time so it can be an olci_io.CompactCube.
     """
     nT, nBands, ys, xs = refl.shape
+    nBands = nBands if nbands is None else nbands
+    if nobs_mean is None:
+        nobs_mean = band_nobs_mean(refl, nBands)
+    # form D.T W D once -- diagonals without alpha
+    w = W[:-1].astype(dtype)
+    b = np.zeros(W.shape, dtype=dtype)
+    b[:-1] += w
+    b[1:] += w
+    # lower and upper are the same so share them
+    AC = np.zeros([nT-1, nBands, ys, xs], dtype=dtype)
+    BC = np.zeros([nT, nBands, ys, xs], dtype=dtype)
+    DC = np.zeros([nT, nBands, ys, xs], dtype=dtype)
+    for band in range(nBands):
+        # scale alpha as in solve_band
+        y = np.asarray(refl[:, band], dtype=dtype)
+        alpha = dtype(np.clip(nobs_mean[band], 20, 250))
+        AC[:, band] = w * -alpha
+        BC[:, band] = b * alpha + (y > 0)
+        DC[:, band] = y
+    return TDMA_MAT(AC, BC, AC, DC, out=DC)
+
+
+def _solve_band_active(A, D, Iobs, nObs, X, W0, WW, CONV, Nits,
+                       alpha, T, drop, MINITER, niter=5):
+    """
+    IRLS loop of solve_band on the active set only
+
+    Weights are only recomputed for pixels whose solution
+    changed in the last solve and only unconverged pixels
+    are re-solved -- everything else is as it was.
+    CONV and Nits are updated in place.
+    """
+    nT = X.shape[0]
+    Xf = X.reshape((nT, -1))
+    WWf = WW.reshape((nT, -1))
+    W0f = W0.reshape((nT, -1))
+    Df = D.reshape((nT, -1))
+    Iobsf = Iobs.reshape((nT, -1))
+    nObsf = nObs.reshape(-1)
+    CONVf = CONV.reshape(-1)
+    Nitsf = Nits.reshape(-1)
+    wmin = np.zeros(CONVf.shape, dtype=WW.dtype)
+    upd = np.arange(CONVf.size)
+    for i in range(niter):
+        _w = irls_weights(Xf.take(upd, axis=1), nObsf[upd], alpha, T, drop)
+        WWf[:, upd] = _w
+        wmin[upd] = WWf[:, upd].min(axis=0)
+        act = np.flatnonzero(~CONVf)
+        LOG.info(f"IRLS iteration {i}: {act.size} of {CONVf.size} pixels active")
+        if act.size:
+            # pack the active pixels into a dense (C ordered) batch
+            Aa = np.empty((nT-1, act.size), dtype=A.dtype)
+            Ba = np.empty((nT, act.size), dtype=A.dtype)
+            Ca = np.empty((nT-1, act.size), dtype=A.dtype)
+            Wa = WWf.take(act, axis=1)
+            penalty_mats(Wa, Iobsf.take(act, axis=1), alpha, Aa, Ba, Ca)
+            Nitsf[act] += 1
+            Xf[:, act] = TDMA_MAT(Aa, Ba, Ca, Df.take(act, axis=1))
+            W0a = W0f.take(act, axis=1)
+            cow = np.sum(np.abs((Wa - W0a) / W0a), axis=0)+ 1e-6
+            CONVf[act[cow<1e-2]] = True
+        upd = act
+        if i< MINITER:
+            CONVf[:]=False
+        CONVf[wmin<0.1]=True
+        W0f = WWf
+    return X, WW
+
+
+@np.errstate(all='ignore')
+def band_nobs_mean(refl, nbands=None):
+    """
+    Mean number of obs per pixel of each band of a (nT, nBands, ys, xs) cube
+    """
+    nbands = refl.shape[1] if nbands is None else nbands
+    return np.array([(refl[:, band] > 0).sum(axis=0).mean()
+                     for band in range(nbands)])
+
+
+def edge_preserving(sensor, refl, band_rmse=None, batch_bands=False,
+                    dtype=DTYPE, nobs_mean=None):
+    """
+
+    batch_bands -- solve all the bands together with solve_bands
+                   rather than calling solve_band for each one
+    dtype       -- float type for the solve and the outputs. Pixels
+                   that come out non-finite in float32 (barely
+                   constrained time series) are re-solved in float64.
+    nobs_mean   -- (nBands,) mean obs per pixel that alpha is scaled
+                   by, defaults to this chunk's
+
+    refl is only decoded a band at a time, so an olci_io.CompactCube
+    never needs more than one band of floats on top of the outputs.
+    """
+    nT, nBands, ys, xs = refl.shape
+    if nobs_mean is None:
+        nobs_mean = band_nobs_mean(refl)
+
+    def iso(band):
+        # one band decoded (or cast) to dtype
+        return np.asarray(refl[:, band], dtype=dtype)
+
     alpha=10
     if sensor == "MODIS" or sensor=='VIIRS':
-        solutions = np.zeros((nT, 7, ys, xs))
-        uncs = np.zeros((nT, 7, ys, xs))
+        solutions = np.zeros((nT, 7, ys, xs), dtype=dtype)
+        uncs = np.zeros((nT, 7, ys, xs), dtype=dtype)
         """
         Do edge preserving on both bands
         """
-        iso = np.copy(refl)
         # do 1 and 4 first and get w
-        X1, W1, C, N, Z1 = solve_band(iso[:, 1],
-                                   alpha=alpha,solve_edge=True, drop=True)
-        X4, Inv, W4, C, N, Z4  = solve_band(iso[:, 4],
-                                  alpha=alpha, solve_edge=True, unc=True, drop=True)
+        X1, W1, C, N, Z1 = solve_band(iso(1),
+                                   alpha=alpha,solve_edge=True, drop=True, dtype=dtype,
+                                   nobs_mean=nobs_mean[1])
+        X4, Inv, W4, C, N, Z4  = solve_band(iso(4),
+                                  alpha=alpha, solve_edge=True, unc=True, drop=True,
+                                  dtype=dtype, nobs_mean=nobs_mean[4])
         pick = np.argmax([Z1, Z4], axis=0)
         idx = np.where(pick==0)
         W4[:, idx[0], idx[1]]=1
         idx = np.where(pick==1)
         W1[:, idx[0], idx[1]]=1
         W = np.minimum(W1, W4)
+        if batch_bands:
+            solutions[:] = solve_bands(refl, W, dtype=dtype,
+                                       nobs_mean=nobs_mean, nbands=7)
         for band in range(7):
-            X, WW =  solve_band(iso[:, band],
-                                  alpha=alpha,solve_edge=False, W=W, )
-            # save them
-            solutions[:, band] = X
+            if not batch_bands:
+                X, WW =  solve_band(iso(band),
+                                      alpha=alpha,solve_edge=False, W=W,
+                                      dtype=dtype, nobs_mean=nobs_mean[band])
+                # save them
+                solutions[:, band] = X
             uncs[:, band] = Inv * MODIS_C_obs[band]
     elif sensor =="OLCI":
-        solutions = np.zeros((nT, 4, ys, xs))
-        uncs = np.zeros((nT, 4, ys, xs))
+        solutions = np.zeros((nT, 4, ys, xs), dtype=dtype)
+        uncs = np.zeros((nT, 4, ys, xs), dtype=dtype)
         """
         Do edge preserving on both bands
         """
-        iso = np.copy(refl)
-        X4, Inv, W4, C, N, Z4  = solve_band(iso[:, 3],
-                                  alpha=alpha, solve_edge=True, unc=True, drop=True)
+        X4, Inv, W4, C, N, Z4  = solve_band(iso(3),
+                                  alpha=alpha, solve_edge=True, unc=True, drop=True,
+                                  dtype=dtype, nobs_mean=nobs_mean[3])
+        if batch_bands:
+            solutions[:] = solve_bands(refl, W4, dtype=dtype,
+                                       nobs_mean=nobs_mean, nbands=4)
         for band in range(4):
-            X, WW =  solve_band(iso[:, band],
-                                  alpha=alpha,solve_edge=False, W=W4)
-            # save them
-            solutions[:, band] = X
+            if not batch_bands:
+                X, WW =  solve_band(iso(band),
+                                      alpha=alpha,solve_edge=False, W=W4,
+                                      dtype=dtype, nobs_mean=nobs_mean[band])
+                # save them
+                solutions[:, band] = X
             uncs[:, band] = Inv * OLCI_C_obs[band]
+    if np.dtype(dtype) != np.float64:
+        # float32 breaks down where exp(-dx**2/T) underflows to zero
+        # weights next to days with no obs -- redo those pixels in float64
+        bad = ~(np.isfinite(solutions).all(axis=(0, 1))
+                & np.isfinite(uncs).all(axis=(0, 1)))
+        if bad.any():
+            LOG.debug(f"re-solving {bad.sum()} pixels in float64")
+            sub = np.stack([refl[:, band][..., bad] for band in range(nBands)],
+                           axis=1)
+            s64, u64 = edge_preserving(sensor, sub[..., None, :],
+                                       band_rmse, batch_bands, np.float64,
+                                       nobs_mean)
+            solutions[..., bad] = s64[..., 0, :]
+            uncs[..., bad] = u64[..., 0, :]
     return solutions, uncs
 
 
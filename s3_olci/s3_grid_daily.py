@@ -14,12 +14,11 @@ from skimage.transform import resize
 import sys
 import zipfile
 import os
-import numpy as np
 import shutil
 from pathlib import Path
-import glob
 import pprint
 import datetime 
+from catalogue import TileCatalogue, find_files, parse_intermediate
 
 if __name__ =="__main__":
     _, tile, year, doy = sys.argv
@@ -32,15 +31,17 @@ if __name__ =="__main__":
     str_date = choosen_date.strftime("%Y%m%d")
     # get files
     ddir = f"/work/scratch/jbrennan01/data/S3/intermediate/{tile}/"
-    files = np.array(glob.glob(ddir+"*.tif"))
-    dates = np.array([f.split("_")[-3][:8]  for f in files  ])
-    idx = np.where(dates==str_date)[0]
+    # the pre-processor adds its tiles to the intermediate catalogue
+    files = find_files(ddir, choosen_date, choosen_date + datetime.timedelta(days=1),
+                       parse=parse_intermediate)
     """
     process the files for this_date
     """
-    the_files = list(files[idx])
+    the_files = [f for d, f in files]
     outfilename = f"S3_SY09_{tile}_{str_date}.tif"
     g = gdal.Warp(outdir+outfilename, the_files, srcNodata=0, creationOptions=["INTERLEAVE=BAND", "TILED=YES", "COMPRESS=DEFLATE", "PREDICTOR=2"])
     g = None
+    # register the new daily file in the gridded catalogue
+    TileCatalogue(outdir).add(outdir+outfilename)
     print(outdir+outfilename, len(the_files))
 
@@ -1,56 +1,213 @@
 """
 s3_pre_process.py
 This re-projects a S3_SYN image to MODIS tile and grid
+
+By default the swath is gridded directly onto the MODIS tiles
+it covers (see swath_grid.py) in one pass from the geolocation
+arrays. --warp uses the old route of a gdal.Warp with the
+geolocation arrays to a EPSG:4326 one.tif and then a second
+gdal.Warp of that to each tile. Its intermediates go in a tmp/
+directory of the granule, or with --in-memory in GDAL's /vsimem/.
+
+Tiles are written next to their destination and renamed into
+place, so a tile file is either complete or not there.
 """
 import gdal
+import osr
 import netCDF4
 from skimage.transform import resize
 import sys
 import zipfile
 import os
+import argparse
 import numpy as np
 import shutil
 from pathlib import Path
-import shapely.wkt
-import json
-from shapely.geometry import shape, GeometryCollection
 import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-if __name__ =="__main__":
+import swath_grid
+from catalogue import TileCatalogue, parse_intermediate
+import modis_tiles
+
+# swath -> tile mappings saved by platform, relative orbit and frame
+LUT_DIR = '/work/scratch/jbrennan01/data/S3/luts/'
+
+MODIS_TILES_FILE = '/home/users/jbrennan01/DATA2/BAFMS/data_preprocessing/modis-tiles.geojson'
+
+CREATION_OPTIONS = ['COMPRESS=DEFLATE', 'INTERLEAVE=BAND', 'PREDICTOR=2']
+
+
+def find_tiles(sen3filep):
+    """
+    The MODIS tiles the swath polygon intersects
+    """
+    return modis_tiles.swath_tiles(sen3filep/"polygon.wkt", MODIS_TILES_FILE)
+
+
+def output_name(sen3filep, the_tile):
+    """
+    Output directory and filename of a tile of a granule
+    """
+    keep = sen3filep.stem.split("_")[:8]
+    start_str =  "".join([keep[0], "_", keep[3], "_", keep[-1]])
+    filename = start_str+f"_{the_tile}.tif"
+    outdir = f'/work/scratch/jbrennan01/data/S3/intermediate/{the_tile}/'
+    return outdir, filename
+
+
+def partial_name(outdir, filename):
+    """
+    Where a tile is written before it is renamed into place -- not
+    a .tif so the catalogues don't pick it up
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir, exist_ok=True)
+    return outdir+f".{filename}.part"
+
+
+def publish(part, outdir, filename):
+    """
+    Renames a finished tile into place and adds it to the catalogue
+    of its directory
+    """
+    os.replace(part, outdir+filename)
+    cat = TileCatalogue(outdir, parse=parse_intermediate)
+    try:
+        cat.add(outdir+filename)
+    finally:
+        cat.close()
 
-    sen3file = sys.argv[1]
-    #sen3file = "S3_SYN_20181201T043035_20181201T043237_20181218T164959_0121_038_304_1980"
-    sen3filep = Path(sen3file)
-    # Figure the MODIS tiles for this image
-    with open(sen3filep/"polygon.wkt", 'r') as f:
-        poly = f.read()
-    olci_swath =  shapely.wkt.loads(poly)
-    # get MODIS tile geometries
-    mod = '/home/users/jbrennan01/DATA2/BAFMS/data_preprocessing/modis-tiles.geojson'
-    with open(mod) as f:
-      features = json.load(f)["features"]
-    # NOTE: buffer(0) is a trick for fixing scenarios where polygons have overlapping coordinates
-    MODIS_TILES = GeometryCollection([shape(feature["geometry"]).buffer(0) for feature in features])
-    tiles = np.array([f"h{f['properties']['ih']}v{f['properties']['iv']}" for f in features])
-
-    # ---------- Find intersecting MODIS tiles ----------------------
-    intersects = [olci_swath.intersects(tile) for tile in MODIS_TILES]
-    idx = np.where(intersects)
-    which_tiles = tiles[idx]
-
-    # --------------- Start processing ------------------------------   
-    # create tmp working dir within the file dir
-    data_dir = str(sen3filep) + '/'
-    work_dir = str(sen3filep) + '/'+ 'tmp'+'/'
-    if not os.path.exists(work_dir):
-        os.makedirs(work_dir)
 
-    # 1. Load lon and lat data for preparation of making VRTS
+def write_text(fname, text):
+    """
+    Writes a text file, on disk or in /vsimem/
+    """
+    f = gdal.VSIFOpenL(fname, 'w')
+    gdal.VSIFWriteL(text, 1, len(text), f)
+    gdal.VSIFCloseL(f)
+
+
+def remove_work_dir(work_dir):
+    """
+    Deletes the intermediates
+    """
+    if work_dir.startswith('/vsimem/'):
+        for i in gdal.ReadDir(work_dir) or []:
+            gdal.Unlink(work_dir+i)
+        gdal.Unlink(work_dir.rstrip('/'))
+        return
+    # Gather directory contents
+    contents = [os.path.join(work_dir, i) for i in os.listdir(work_dir)]
+    # Iterate and remove each item in the appropriate manner
+    [os.remove(i) if os.path.isfile(i) or os.path.islink(i) else shutil.rmtree(i) for i in contents]
+    os.rmdir(work_dir)
+
+
+def read_swath(data_dir):
+    """
+    lon, lat and the (8, ys, xs) stack of Oa03, Oa06, Oa08, Oa18,
+    qa, vza, sza and raa of a granule
+    """
+    # 1. Load lon and lat data
     geo = netCDF4.Dataset(data_dir+"geolocation.nc", 'r')
     lon = geo['lon'][:]
     lat = geo['lat'][:]
     # get dims of raster
     ysize, xsize = lon.shape
+    stack = np.zeros((8, ysize, xsize), dtype=np.float32)
+    # *-- Reflectance --*
+    #            blue    green   red     NIR
+    channels = ["Oa03", "Oa06", "Oa08", "Oa18"]
+    for band, chn in enumerate(channels):
+        """
+        Load data for this band
+        """
+        ds = netCDF4.Dataset(data_dir+f"Syn_{chn}_reflectance.nc")
+        data = ds.variables[f'SDR_{chn}'][:]
+        stack[band] = data.data
+    """
+    *-- QA --*
+    Make a QA band from the data
+    for now just use the mask provided
+    """
+    band +=1
+    stack[band] = ~np.ma.getmaskarray(data)
+    """
+    *-- Angles --*
+    First SZA, VZA, RAA:
+    Working on getting angles out of shitty format
+    Got to be speed-up for this?
+    """
+    angs = netCDF4.Dataset(data_dir+"tiepoints_olci.nc", 'r')
+    angles = {'OLC_VZA':None, 'SZA':None, 'OLC_VAA':None, 'SAA':None}
+    for key in angles.keys():
+        an_ = angs[key][:]
+        an_ = an_.reshape((-1, ysize)).T
+        ang=  resize(an_, (ysize, xsize), order=0, preserve_range=True)
+        # check this is the right way around
+        angles[key]=ang
+    stack[band+1] = angles['OLC_VZA']
+    stack[band+2] = angles['SZA']
+    stack[band+3] = angles['OLC_VAA'] - angles['SAA']
+    return lon, lat, stack
+
+
+def write_tile(fname, grid, h, v):
+    """
+    Writes a (bands, 2400, 2400) grid as a GeoTIFF of tile h, v
+    """
+    nb, ny, nx = grid.shape
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(fname, nx, ny, nb, gdal.GDT_Float32,
+                            options=CREATION_OPTIONS)
+    dataset.SetGeoTransform(swath_grid.tile_geotransform(h, v, nx))
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4(swath_grid.SINUSOIDAL)
+    dataset.SetProjection(srs.ExportToWkt())
+    for band in range(nb):
+        dataset.GetRasterBand(band+1).WriteArray(grid[band])
+    dataset = None
+
+
+def direct_tiles(sen3filep, data_dir, lut_dir=LUT_DIR):
+    """
+    Grids the swath straight onto each tile it covers
+
+    With a lut_dir the swath -> tile mapping of a granule on the
+    same track is reused if its geolocation matches.
+    """
+    lon, lat, stack = read_swath(data_dir)
+    # only the (land) tiles of the tiles file
+    tiles = modis_tiles.get_index(MODIS_TILES_FILE)
+    if lut_dir is None:
+        mapping = swath_grid.swath_mapping(lon, lat, tiles=tiles)
+    else:
+        mapping = swath_grid.cached_mapping(lut_dir,
+                                            swath_grid.granule_key(sen3filep.name),
+                                            lon, lat, tiles=tiles)
+    results = []
+    for the_tile, (src, dst) in mapping.items():
+        outdir, filename = output_name(sen3filep, the_tile)
+        try:
+            grid = swath_grid.grid_tile(stack, src, dst)
+            part = partial_name(outdir, filename)
+            write_tile(part, grid, int(the_tile[1:3]), int(the_tile[4:6]))
+            publish(part, outdir, filename)
+            results.append((sen3filep.name, the_tile, outdir+filename, None))
+        except Exception as e:
+            results.append((sen3filep.name, the_tile, outdir+filename, repr(e)))
+    return results
+
+
+def prepare_warp(sen3filep, data_dir, work_dir):
+    """
+    Warps the swath to a EPSG:4326 one.tif in work_dir and returns
+    the tiles it covers
+    """
+    which_tiles = find_tiles(sen3filep)
+    lon, lat, stack = read_swath(data_dir)
+    ysize, xsize = lon.shape
 
     # Save this lon/lat to TIFFs and VRT
     driver = gdal.GetDriverByName('GTiff')
@@ -100,10 +257,8 @@ if __name__ =="__main__":
 </VRTDataset>"""
 
     # save VRT files now
-    with open(work_dir+"lon.vrt", "w") as text_file:
-        text_file.write(lon_vrt)
-    with open(work_dir+"lat.vrt", "w") as text_file:
-        text_file.write(lat_vrt)
+    write_text(work_dir+"lon.vrt", lon_vrt)
+    write_text(work_dir+"lat.vrt", lat_vrt)
 
     # Pull out the data we need and put into a .tif
     dataset = driver.Create(
@@ -112,45 +267,8 @@ if __name__ =="__main__":
         ysize,
         8,
         gdal.GDT_Float32, )
-
-    # *-- Reflectance --*
-    #            blue    green   red     NIR
-    channels = ["Oa03", "Oa06", "Oa08", "Oa18"]
-    for band, chn in enumerate(channels):
-        """
-        Load data for this band
-        """
-        ds = netCDF4.Dataset(data_dir+f"Syn_{chn}_reflectance.nc")
-        data = ds.variables[f'SDR_{chn}'][:]
-        bnd = dataset.GetRasterBand(band+1).WriteArray(data.data)
-    """
-    *-- QA --*
-    Make a QA band from the data
-    for now just use the mask provided
-    """
-    band +=1
-    qa = ~data.mask
-    bnd = dataset.GetRasterBand(band+1).WriteArray(qa)
-    #dataset = None
-    """
-    *-- Angles --*
-    First SZA, VZA, RAA:
-    Working on getting angles out of shitty format
-    Got to be speed-up for this?
-    """
-    angs = netCDF4.Dataset(data_dir+"tiepoints_olci.nc", 'r')
-    #latS, lonS = angs['OLC_TP_lat'][:], angs['OLC_TP_lon'][:]
-    angles = {'OLC_VZA':None, 'SZA':None, 'OLC_VAA':None, 'SAA':None}
-    for key in angles.keys():
-        an_ = angs[key][:]
-        an_ = an_.reshape((-1, ysize)).T
-        ang=  resize(an_, (ysize, xsize), order=0, preserve_range=True)
-        # check this is the right way around
-        angles[key]=ang
-    band +=1
-    bnd = dataset.GetRasterBand(band+1).WriteArray(angles['OLC_VZA'])
-    bnd = dataset.GetRasterBand(band+2).WriteArray(angles['SZA'])
-    bnd = dataset.GetRasterBand(band+3).WriteArray(angles['OLC_VAA'] - angles['SAA'])
+    for band in range(8):
+        dataset.GetRasterBand(band+1).WriteArray(stack[band])
     # Write to file
     dataset = None
     # Write the main VRT with this data
@@ -184,58 +302,224 @@ if __name__ =="__main__":
            {band_str}
 </VRTDataset>"""
     # save it
-    with open(work_dir+"data.vrt", "w") as text_file:
-        text_file.write(vrt_main_tmpl)
+    write_text(work_dir+"data.vrt", vrt_main_tmpl)
 
     # make a real geotiff now
-    g = gdal.Warp(work_dir+"one.tif", work_dir+"data.vrt", dstSRS="EPSG:4326", geoloc=True)
-    """
-    Perform re-projection to the MODIS grid
-    for each tile
-    """
-    for the_tile in which_tiles:
-        # Get the modis reference tile e.g. from MCD64
-        t = 'HDF4_EOS:EOS_GRID:"%s":MOD_Grid_Monthly_500m_DB_BA:Burn Date'
-        # form a filename
-        keep = sen3filep.stem.split("_")[:8]
-        start_str =  "".join([keep[0], "_", keep[3], "_", keep[-1]])
-        filename = start_str+f"_{the_tile}.tif"
-        outdir = f'/work/scratch/jbrennan01/data/S3/intermediate/{the_tile}/'
+    # not kept so it is closed (and written) straight away
+    gdal.Warp(work_dir+"one.tif", work_dir+"data.vrt", dstSRS="EPSG:4326", geoloc=True)
+    return list(which_tiles)
+
+
+def warp_tile(sen3filep, work_dir, the_tile):
+    """
+    Re-projects one.tif to a MODIS tile, returns (granule, tile,
+    output, error)
+    """
+    # Get the modis reference tile e.g. from MCD64
+    t = 'HDF4_EOS:EOS_GRID:"%s":MOD_Grid_Monthly_500m_DB_BA:Burn Date'
+    # form a filename
+    outdir, filename = output_name(sen3filep, the_tile)
+    try:
+        mcd64dir = f'/home/users/jbrennan01/DATA2/TColBA/input_products/MCD64/{the_tile}/2005/'
+        rr = glob.glob(mcd64dir+"*hdf")[0]
+        modis_ds = gdal.Open(t % rr)
+        geoTransform = modis_ds.GetGeoTransform()
+        minx = geoTransform[0]
+        maxy = geoTransform[3]
+        maxx = minx + geoTransform[1] * modis_ds.RasterXSize
+        miny = maxy + geoTransform[5] * modis_ds.RasterYSize
+        # Re-project to WGS84 first -- not sure why but seem to need to
+        part = partial_name(outdir, filename)
+        # not kept so it is closed (and written) before publishing
+        gdal.Warp(part, work_dir+"one.tif", format='GTiff',
+                        dstSRS=modis_ds.GetProjection(),  outputBounds=(minx, miny, maxx, maxy),
+                            xRes= 463.312719959778804, yRes=-463.312716551443543,
+                    creationOptions=CREATION_OPTIONS, multithread=True)
+        publish(part, outdir, filename)
+        return (sen3filep.name, the_tile, outdir+filename, None)
+    except Exception as e:
+        return (sen3filep.name, the_tile, outdir+filename, repr(e))
+
+
+def disk_work_dir(sen3filep):
+    """
+    tmp working dir within the file dir
+    """
+    return str(sen3filep) + '/'+ 'tmp'+'/'
+
+
+def make_work_dir(sen3filep, in_memory=False):
+    """
+    tmp working dir within the file dir or in memory
+    """
+    if in_memory:
+        return f'/vsimem/{sen3filep.name}/'
+    work_dir = disk_work_dir(sen3filep)
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    return work_dir
+
+
+def process_granule(sen3file, warp=False, in_memory=False, lut_dir=LUT_DIR):
+    """
+    Re-projects a granule to all the tiles it covers
+
+    Returns a (granule, tile, output, error) for each tile, error
+    is None if it worked. A granule that couldn't be read at all
+    gives one result with no tile.
+    """
+    sen3filep = Path(sen3file)
+    data_dir = str(sen3filep) + '/'
+    try:
+        if not warp:
+            return direct_tiles(sen3filep, data_dir, lut_dir=lut_dir)
+        work_dir = make_work_dir(sen3filep, in_memory)
         try:
-            mcd64dir = f'/home/users/jbrennan01/DATA2/TColBA/input_products/MCD64/{the_tile}/2005/'
-            rr = glob.glob(mcd64dir+"*hdf")[0]
-            modis_ds = gdal.Open(t % rr)
-            geoTransform = modis_ds.GetGeoTransform()
-            minx = geoTransform[0]
-            maxy = geoTransform[3]
-            maxx = minx + geoTransform[1] * modis_ds.RasterXSize
-            miny = maxy + geoTransform[5] * modis_ds.RasterYSize
-            # Re-project to WGS84 first -- not sure why but seem to need to
-            co = 'COMPRESS=DEFLATE', 'INTERLEAVE=BAND', 'PREDICTOR=2'
-            g = gdal.Warp(work_dir+f"{the_tile}.tif", work_dir+"one.tif",
-                            dstSRS=modis_ds.GetProjection(),  outputBounds=(minx, miny, maxx, maxy),
-                                xRes= 463.312719959778804, yRes=-463.312716551443543,
-                        creationOptions=co)
-            g = None
-            """
-            Do some cleanup
-            1. Delete files
-            2. Move output MOD product
-            3. rm unzipped file and dir//
-            """
-            if not os.path.exists(outdir):
-                os.makedirs(outdir)
-            shutil.move(work_dir+f"{the_tile}.tif", outdir+filename)
-            print("success: ", outdir+filename)
-        except:
-            print("failed:  ", outdir+filename)
-
-    # Now tidy everything up.. eg delete tmp files
-    # Gather directory contents
-    contents = [os.path.join(work_dir, i) for i in os.listdir(work_dir)]
-    # Iterate and remove each item in the appropriate manner
-    [os.remove(i) if os.path.isfile(i) or os.path.islink(i) else shutil.rmtree(i) for i in contents]
-    os.rmdir(work_dir)
+            which_tiles = prepare_warp(sen3filep, data_dir, work_dir)
+            return [warp_tile(sen3filep, work_dir, the_tile)
+                    for the_tile in which_tiles]
+        finally:
+            # Now tidy everything up.. eg delete tmp files
+            remove_work_dir(work_dir)
+    except Exception as e:
+        return [(sen3filep.name, None, None, repr(e))]
+
+
+def init_worker(cache_mb=512, n_threads=1):
+    """
+    GDAL settings of a worker process
+    """
+    gdal.SetCacheMax(cache_mb * 1024 * 1024)
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(n_threads))
+
+
+def _prepare_task(sen3file):
+    sen3filep = Path(sen3file)
+    work_dir = make_work_dir(sen3filep)
+    try:
+        return work_dir, prepare_warp(sen3filep, str(sen3filep) + '/', work_dir), None
+    except Exception as e:
+        return work_dir, [], repr(e)
 
 
+def run_batch(granules, workers=1, warp=False, in_memory=False,
+              lut_dir=LUT_DIR, cache_mb=512, n_threads=1):
+    """
+    Re-projects many granules on a process pool
 
+    The double warp route with on-disk intermediates makes each
+    one.tif and then fans the (granule, tile) warps out over the
+    pool. Otherwise (one.tif in /vsimem/ can't be shared between
+    processes, the direct route is cheap per tile) a worker does a
+    granule at a time. Returns all the (granule, tile, output,
+    error) results -- a granule or tile whose worker raised or
+    died is a failed result rather than stopping the batch.
+    """
+    results = []
+    on_disk = warp and not in_memory
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(cache_mb, n_threads)) as pool:
+            if not on_disk:
+                futures = {pool.submit(process_granule, g, warp, in_memory,
+                                       lut_dir): (Path(g).name, None)
+                           for g in granules}
+                _collect(futures, results)
+                return results
+            prepared = {pool.submit(_prepare_task, g): g for g in granules}
+            futures = {}
+            for future in as_completed(prepared):
+                g = prepared[future]
+                try:
+                    work_dir, which_tiles, error = future.result()
+                except Exception as e:
+                    which_tiles, error = [], repr(e)
+                if error is not None:
+                    results.append((Path(g).name, None, None, error))
+                for the_tile in which_tiles:
+                    try:
+                        futures[pool.submit(warp_tile, Path(g), work_dir,
+                                            the_tile)] = (Path(g).name, the_tile)
+                    except Exception as e:
+                        # the pool broke while the others were prepared
+                        results.append((Path(g).name, the_tile, None, repr(e)))
+            _collect(futures, results)
+    finally:
+        if on_disk:
+            # work dirs are made in the workers, tidy up even the
+            # ones of granules that failed
+            for g in granules:
+                work_dir = disk_work_dir(Path(g))
+                if os.path.isdir(work_dir):
+                    remove_work_dir(work_dir)
+    return results
+
+
+def _collect(futures, results):
+    """
+    Adds the results of {future: (granule, tile)} to results as they
+    finish, a future that raised (eg BrokenProcessPool when a worker
+    is killed) gives a failed result
+    """
+    for future in as_completed(futures):
+        granule, the_tile = futures[future]
+        try:
+            result = future.result()
+        except Exception as e:
+            results.append((granule, the_tile, None, repr(e)))
+            continue
+        if the_tile is None:
+            results.extend(result)
+        else:
+            results.append(result)
+
+
+def summarise(results):
+    """
+    Prints the failures and counts of a run, returns the number
+    of failures
+    """
+    failed = [r for r in results if r[3] is not None]
+    for granule, the_tile, output, error in sorted(failed, key=str):
+        print(f"failed:  {granule} {the_tile or '(granule)'}: {error}")
+    n_granules = len({r[0] for r in results})
+    print(f"{len(results) - len(failed)} tiles written, {len(failed)} failed "
+          f"from {n_granules} granules")
+    return len(failed)
+
+
+if __name__ =="__main__":
+    parser = argparse.ArgumentParser(description='Re-project S3_SYN granules to the MODIS tiles they cover.')
+    parser.add_argument('sen3file', nargs='+', help='S3_SYN directories')
+    parser.add_argument('--warp', action='store_true',
+                        help='Use the double gdal.Warp rather than gridding the swath directly')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='With --warp keep the intermediates in /vsimem/ rather than a tmp/ directory')
+    parser.add_argument('--lut-dir', default=LUT_DIR,
+                        help='Directory of swath to tile mappings to reuse by platform, relative orbit and frame')
+    parser.add_argument('--no-lut', action='store_true',
+                        help="Don't save or reuse swath to tile mappings")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processes to run the granules (or tiles) on')
+    parser.add_argument('--gdal-cache', type=int, default=512,
+                        help='GDAL block cache of each worker in MB')
+    parser.add_argument('--gdal-threads', type=int, default=None,
+                        help='GDAL_NUM_THREADS of each worker for the warps (default cpus / workers)')
+    args = parser.parse_args()
+
+    #sen3file = "S3_SYN_20181201T043035_20181201T043237_20181218T164959_0121_038_304_1980"
+    n_threads = args.gdal_threads or max(1, (os.cpu_count() or 1) // args.workers)
+    lut_dir = None if args.no_lut else args.lut_dir
+    if args.workers > 1:
+        results = run_batch(args.sen3file, args.workers, args.warp,
+                            args.in_memory, lut_dir, args.gdal_cache, n_threads)
+    else:
+        init_worker(args.gdal_cache, n_threads)
+        results = []
+        for sen3file in args.sen3file:
+            results += process_granule(sen3file, args.warp, args.in_memory,
+                                       lut_dir)
+    for granule, the_tile, output, error in results:
+        if error is None:
+            print("success: ", output)
+    sys.exit(1 if summarise(results) else 0)
@@ -0,0 +1,150 @@
+"""
+s3_regularise_tile.py
+
+Runs the edge preserving regularisation over a whole MODIS tile
+
+A full tile over a year doesn't fit in memory so the tile is
+split into spatial chunks. Each chunk is loaded with OLCI_refl
+and solved on a process pool. Solutions and uncertainties are
+written into memory-mapped .npy cubes of (nT, nBands, ys, xs)
+and every finished chunk leaves a marker file, so re-running
+the same command skips the chunks that are already done.
+
+    python s3_regularise_tile.py h20v08 2019-01-01 2020-01-01 ./out --workers 8
+"""
+import sys
+import logging
+import argparse
+import datetime
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from olci_io import OLCI_refl
+from chunks import make_chunks, TILE_SIZE
+import regularisation
+
+LOG = logging.getLogger(__name__)
+
+N_BANDS = 4
+
+
+def create_outputs(outdir, start_date, end_date, tile_size=TILE_SIZE):
+    """
+    Makes the memory-mapped output cubes if they don't already exist
+    """
+    outdir = Path(outdir)
+    (outdir / "done").mkdir(parents=True, exist_ok=True)
+    nT = (end_date - start_date).days
+    shape = (nT, N_BANDS, tile_size, tile_size)
+    for name in ["solutions", "uncs"]:
+        fname = outdir / f"{name}.npy"
+        if not fname.exists():
+            # only makes the file, the memmap is closed straight away
+            np.lib.format.open_memmap(fname, mode='w+', dtype=np.float32,
+                                      shape=shape)
+    dates = [start_date + datetime.timedelta(days=x) for x in range(nT)]
+    np.save(outdir / "dates.npy", np.array(dates, dtype='datetime64[D]'))
+    return shape
+
+
+def chunk_marker(outdir, chunk):
+    """
+    Marker file written once a chunk is safely on disk
+    """
+    y0, y1, x0, x1 = chunk
+    return Path(outdir) / "done" / f"y{y0:04d}_{y1:04d}_x{x0:04d}_{x1:04d}"
+
+
+def init_worker(threads=1):
+    """
+    Stop every worker's numba kernels from using all the cores
+    """
+    regularisation.nb.set_num_threads(threads)
+
+
+def process_chunk(tile, start_date, end_date, chunk, outdir, store=None,
+                  compact=False):
+    """
+    Loads one chunk, runs edge_preserving and writes into the outputs
+
+    With compact the chunk is held as int16 (see OLCI_refl) and
+    only decoded a band at a time.
+    """
+    y0, y1, x0, x1 = chunk
+    o = OLCI_refl(tile, start_date, end_date, x0, y0, x1, y1, store=store,
+                  compact=compact, keep_angles=not compact)
+    o.loadData()
+    refl = o.data['refl']
+    # bad obs are filled with -1e04 -- solver wants these as 0
+    for band in range(refl.shape[1]):
+        obs = refl[:, band]
+        obs[obs < 0] = 0
+        refl[:, band] = obs
+    solutions, uncs = regularisation.edge_preserving("OLCI", refl,
+                                                     batch_bands=True)
+    for name, arr in [("solutions", solutions), ("uncs", uncs)]:
+        out = np.load(Path(outdir) / f"{name}.npy", mmap_mode='r+')
+        out[:, :, y0:y1, x0:x1] = arr
+        out.flush()
+        del out
+    chunk_marker(outdir, chunk).touch()
+    return chunk
+
+
+def run_tile(tile, start_date, end_date, outdir, chunk_size=200, workers=4,
+             tile_size=TILE_SIZE, store=None, compact=False):
+    """
+    Runs all the chunks of a tile that aren't done yet on a process pool
+
+    Returns a list of the chunks that failed. With a store from
+    tile_store.py the chunks are read from it -- best with chunk_size
+    the same as the store's chunk. compact trades some decoding time
+    for holding each chunk in about half the memory.
+    """
+    create_outputs(outdir, start_date, end_date, tile_size)
+    chunks = [c for c in make_chunks(tile_size, chunk_size)
+              if not chunk_marker(outdir, c).exists()]
+    LOG.info(f"{tile}: {len(chunks)} chunks to do with {workers} workers")
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker) as pool:
+        futures = {pool.submit(process_chunk, tile, start_date, end_date,
+                               chunk, outdir, store, compact): chunk
+                   for chunk in chunks}
+        for n, future in enumerate(as_completed(futures)):
+            chunk = futures[future]
+            try:
+                future.result()
+                LOG.info(f"[{n+1}/{len(chunks)}] done chunk {chunk}")
+            except Exception as e:
+                LOG.error(f"[{n+1}/{len(chunks)}] failed chunk {chunk}: {e}")
+                failed.append(chunk)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Edge preserving regularisation of a full MODIS tile of gridded OLCI data.')
+    parser.add_argument('tile', help='MODIS tile eg h20v08')
+    parser.add_argument('start', help='Start date YYYY-MM-DD')
+    parser.add_argument('end', help='End date YYYY-MM-DD (not included)')
+    parser.add_argument('outdir', help='Output directory for the solutions/uncs cubes')
+    parser.add_argument('--chunk', type=int, default=200,
+                        help='Chunk size in pixels')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of worker processes')
+    parser.add_argument('--store', default=None,
+                        help='Read from a tile store made by tile_store.py')
+    parser.add_argument('--compact', action='store_true',
+                        help='Hold each chunk as int16 to cut worker memory')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start_date = datetime.datetime.strptime(args.start, "%Y-%m-%d")
+    end_date = datetime.datetime.strptime(args.end, "%Y-%m-%d")
+    failed = run_tile(args.tile, start_date, end_date, args.outdir,
+                      chunk_size=args.chunk, workers=args.workers,
+                      store=args.store, compact=args.compact)
+    if failed:
+        print(f"{len(failed)} chunks failed -- re-run to retry them")
+        sys.exit(1)
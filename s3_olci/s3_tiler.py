@@ -11,6 +11,8 @@ from skimage.transform import resize
 
 from shapely.geometry import shape, GeometryCollection
 
+import modis_tiles
+
 
 def create_vrts(fname, xsize, ysize):
     vrt = f"""<VRTDataset rasterXSize="{xsize}" rasterYSize="{ysize}">
@@ -131,13 +133,12 @@ def read_s3syn_polyfile(s3_granule):
     return shapely.wkt.loads(s3_granule.read_text())
 
 def get_modis_tile_extent(selected_tile,  modis_tile_list):
-    modis_tile_list = Path(modis_tile_list)
-    features = json.loads(modis_tile_list.read_text())['features']
-    compare = lambda f: f"h{f['properties']['ih']}v{f['properties']['iv']}"
-    modis_tile = GeometryCollection([shape(feat['geometry']).buffer(0)
-                                    for feat in features
-                                    if compare(feat) == selected_tile])
-    return modis_tile
+    # the tiles file is only read once (see modis_tiles.py)
+    index = modis_tiles.get_index(str(modis_tile_list))
+    if selected_tile not in index:
+        # not a (land) tile in the file -- empty like no matching feature
+        return GeometryCollection()
+    return GeometryCollection([index.geometry(selected_tile)])
 
 def find_swaths(doy, year, data_dir):
     path = Path(data_dir) / f"{year}/{doy}"
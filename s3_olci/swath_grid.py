@@ -0,0 +1,250 @@
+"""
+swath_grid.py
+Maps OLCI swath pixels straight onto the MODIS sinusoidal tiles
+
+The MODIS grid is closed form: a sinusoidal projection on a
+sphere split into 36 x 18 tiles of 10 degrees (at the equator)
+with 2400 x 2400 pixels at 500 m. So the (h, v, row, col) of
+every swath pixel comes from its lon/lat in a few array ops,
+with no geolocation warp and no intermediate rasters.
+
+Each tile cell takes the swath pixel nearest its centre and
+small holes (cells missed between swath pixels) take a
+neighbour's pixel. The result is a mapping per tile of swath
+pixel -> tile pixel, so gridding a band is a gather.
+
+Sentinel-3 repeats its ground track every 27 days so mappings
+can be saved keyed on platform, relative orbit and frame and
+reused for later granules on the same track, after checking
+their geolocation matches.
+"""
+import os
+import logging
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+# sphere of the MODIS sinusoidal grid
+R = 6371007.181
+TILE_WIDTH = 2 * np.pi * R / 36
+NH, NV = 36, 18
+NPIX = 2400
+
+SINUSOIDAL = "+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +R=6371007.181 +units=m +no_defs"
+
+# swath rows done at a time, keeps the float64 temporaries small
+BLOCK = 512
+
+# geolocation is checked every CHECK_STEP pixels and must be within
+# CHECK_TOL (in pixels of the grid) to reuse a saved mapping
+CHECK_STEP = 64
+CHECK_TOL = 0.25
+
+
+def tile_name(h, v):
+    return f"h{h:02d}v{v:02d}"
+
+
+def sinusoidal_xy(lon, lat):
+    """
+    Sinusoidal x, y (m) of lon/lat (degrees)
+    """
+    lat = np.radians(lat)
+    return R * np.radians(lon) * np.cos(lat), R * lat
+
+
+def tile_geotransform(h, v, npix=NPIX):
+    """
+    GDAL geotransform of tile h, v
+    """
+    pixel = TILE_WIDTH / npix
+    return (h * TILE_WIDTH - NH / 2 * TILE_WIDTH, pixel, 0.,
+            NV / 2 * TILE_WIDTH - v * TILE_WIDTH, 0., -pixel)
+
+
+def grid_index(lon, lat, npix=NPIX):
+    """
+    Global (row, col) in the grid of tiles of npix pixels and the
+    squared distance (in pixels) to the centre of that cell
+    """
+    x, y = sinusoidal_xy(lon, lat)
+    pixel = TILE_WIDTH / npix
+    fc = (x + NH / 2 * TILE_WIDTH) / pixel
+    fr = (NV / 2 * TILE_WIDTH - y) / pixel
+    col = np.floor(fc)
+    row = np.floor(fr)
+    d2 = (fc - col - 0.5)**2 + (fr - row - 0.5)**2
+    return row.astype(np.int32), col.astype(np.int32), d2.astype(np.float32)
+
+
+def _fill_holes(index, min_neighbours=5):
+    """
+    Gives empty cells with at least min_neighbours of their 8
+    neighbours filled the swath pixel of one of them, in place
+
+    Cells along the swath edge have fewer filled neighbours so
+    the swath doesn't grow.
+    """
+    ny, nx = index.shape
+    padded = np.pad(index, 1, constant_values=-1)
+    count = np.zeros(index.shape, dtype=np.int8)
+    donor = np.full(index.shape, -1, dtype=index.dtype)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy == 0 and dx == 0:
+                continue
+            nb = padded[1 + dy:1 + dy + ny, 1 + dx:1 + dx + nx]
+            count += nb >= 0
+            np.copyto(donor, nb, where=donor < 0)
+    holes = (index < 0) & (count >= min_neighbours)
+    index[holes] = donor[holes]
+    return holes.sum()
+
+
+def swath_mapping(lon, lat, npix=NPIX, tiles=None, fill_holes=True,
+                  block=BLOCK):
+    """
+    Swath pixel -> tile pixel mapping of every tile the swath covers
+
+    lon, lat are the (ys, xs) geolocation arrays, masked or nan
+    where there is none. tiles limits the output to those tile
+    names eg the land tiles. Returns {tile name: (src, dst)} with
+    src the flat index of swath pixels and dst the flat index of
+    the tile pixels they go to.
+    """
+    lon = np.ma.filled(np.ma.asarray(lon, dtype=np.float64), np.nan)
+    lat = np.ma.filled(np.ma.asarray(lat, dtype=np.float64), np.nan)
+    xs = lon.shape[1]
+    rows, cols, d2, src = [], [], [], []
+    for y0 in range(0, lon.shape[0], block):
+        _lon = lon[y0:y0 + block].ravel()
+        _lat = lat[y0:y0 + block].ravel()
+        ok = np.isfinite(_lon) & np.isfinite(_lat)
+        r, c, d = grid_index(_lon[ok], _lat[ok], npix)
+        rows.append(r)
+        cols.append(c)
+        d2.append(d)
+        src.append(y0 * xs + np.flatnonzero(ok))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    d2 = np.concatenate(d2)
+    src = np.concatenate(src)
+    # nearest to the cell centre first, then one pixel per cell
+    cell = rows.astype(np.int64) * (NH * npix) + cols
+    order = np.lexsort((d2, cell))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = cell[order][1:] != cell[order][:-1]
+    keep = order[first]
+    rows, cols, src = rows[keep], cols[keep], src[keep]
+    hv = (cols // npix) * NV + rows // npix
+    mapping = {}
+    for k in np.unique(hv):
+        h, v = divmod(int(k), NV)
+        name = tile_name(h, v)
+        if tiles is not None and name not in tiles:
+            continue
+        sel = hv == k
+        r = rows[sel] - v * npix
+        c = cols[sel] - h * npix
+        s = src[sel]
+        if fill_holes:
+            # work in the bounding box of the swath in the tile
+            r0, r1 = max(r.min() - 1, 0), min(r.max() + 2, npix)
+            c0, c1 = max(c.min() - 1, 0), min(c.max() + 2, npix)
+            index = np.full((r1 - r0, c1 - c0), -1, dtype=np.int64)
+            index[r - r0, c - c0] = s
+            _fill_holes(index)
+            r, c = np.nonzero(index >= 0)
+            s = index[r, c]
+            r, c = r + r0, c + c0
+        mapping[name] = (s, (r * npix + c).astype(np.int32))
+    return mapping
+
+
+def grid_tile(data, src, dst, npix=NPIX, fill=0):
+    """
+    Grids a (bands, ys, xs) swath stack onto a (bands, npix, npix) tile
+    """
+    data = data.reshape(data.shape[0], -1)
+    out = np.full((data.shape[0], npix * npix), fill, dtype=data.dtype)
+    out[:, dst] = data[:, src]
+    return out.reshape(-1, npix, npix)
+
+
+def granule_key(name):
+    """
+    Platform, relative orbit and frame of a granule eg
+    S3A_SYN_20190828T080636_20190828T080936_20190830T040137_0180_048_306_2880
+    -> S3A_306_2880
+
+    S3A and S3B fly the same relative orbits on different ground
+    tracks so the platform is part of the key.
+    """
+    parts = name.split("_")
+    return f"{parts[0]}_{int(parts[7]):03d}_{int(parts[8]):04d}"
+
+
+def geo_samples(lon, lat, step=CHECK_STEP):
+    """
+    Sinusoidal x, y (m) of every step'th swath pixel, nan where
+    there is no geolocation
+    """
+    lon = np.ma.filled(np.ma.asarray(lon[::step, ::step], dtype=np.float64), np.nan)
+    lat = np.ma.filled(np.ma.asarray(lat[::step, ::step], dtype=np.float64), np.nan)
+    return np.stack(sinusoidal_xy(lon, lat))
+
+
+def save_mapping(fname, mapping, lon, lat, npix=NPIX):
+    """
+    Saves a swath_mapping with what is needed to check it fits
+    another granule
+    """
+    arrays = dict(shape=np.array(lon.shape), npix=np.array(npix),
+                  samples=geo_samples(lon, lat),
+                  tiles=np.array(list(mapping), dtype=str))
+    for name, (src, dst) in mapping.items():
+        arrays[f"{name}_src"] = src.astype(np.int32)
+        arrays[f"{name}_dst"] = dst
+    tmp = f"{fname}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp, **arrays)
+    os.replace(tmp, fname)
+
+
+def load_mapping(fname, lon, lat, npix=NPIX, tol=CHECK_TOL):
+    """
+    Loads a saved mapping, None if it doesn't fit the geolocation
+    of this granule
+    """
+    with np.load(fname) as f:
+        if tuple(f['shape']) != lon.shape or int(f['npix']) != npix:
+            return None
+        samples = geo_samples(lon, lat)
+        dist = np.hypot(*(samples - f['samples']))
+        ok = np.isnan(samples[0]) == np.isnan(f['samples'][0])
+        if not ok.all() or np.nanmax(dist, initial=0) > tol * TILE_WIDTH / npix:
+            LOG.info(f"{fname} doesn't fit: geolocation off by up to "
+                     f"{np.nanmax(dist, initial=0):.0f} m")
+            return None
+        return {str(name): (f[f"{name}_src"], f[f"{name}_dst"])
+                for name in f['tiles']}
+
+
+def cached_mapping(lut_dir, key, lon, lat, npix=NPIX, tiles=None, **kwargs):
+    """
+    swath_mapping of a granule, from lut_dir if a granule on the
+    same track has been done, else made and saved there
+    """
+    fname = os.path.join(lut_dir, f"{key}_{npix}.npz")
+    if os.path.exists(fname):
+        mapping = load_mapping(fname, lon, lat, npix)
+        if mapping is not None:
+            LOG.info(f"using mapping {fname}")
+            if tiles is not None:
+                mapping = {k: m for k, m in mapping.items() if k in tiles}
+            return mapping
+    mapping = swath_mapping(lon, lat, npix, **kwargs)
+    os.makedirs(lut_dir, exist_ok=True)
+    save_mapping(fname, mapping, lon, lat, npix)
+    if tiles is not None:
+        mapping = {k: m for k, m in mapping.items() if k in tiles}
+    return mapping
@@ -0,0 +1,122 @@
+"""
+tile_store.py
+Consolidates the daily gridded files of a tile into one chunked
+NetCDF store
+
+regularisation and brdf work on time-major cubes but the daily
+files mean every chunk load opens every day. The store holds
+refl, qa and angles chunked as (all days, chunk, chunk) so a
+chunk's time series is one contiguous read. Read it with
+OLCI_refl(..., store=fname). The data are stored unscreened,
+screening (see masking.py) is done when a chunk is loaded.
+
+The export goes a block at a time and records finished blocks
+in the store, so it can be re-run if killed.
+
+    python tile_store.py h20v08 2019-01-01 2020-01-01 h20v08_2019.nc --chunk 256
+"""
+import os
+import logging
+import argparse
+import datetime
+import numpy as np
+import netCDF4
+
+from olci_io import OLCI_refl
+from chunks import make_chunks, TILE_SIZE
+
+LOG = logging.getLogger(__name__)
+
+STORE_CHUNK = 256
+
+
+def create_store(fname, tile, start_date, end_date, tile_size=TILE_SIZE,
+                 chunk=STORE_CHUNK):
+    """
+    Makes an empty store for a tile and date range
+    """
+    nT = (end_date - start_date).days
+    nblk = -(-tile_size // chunk)
+    with netCDF4.Dataset(fname, 'w') as nc:
+        nc.tile = tile
+        nc.start_date = start_date.strftime("%Y-%m-%d")
+        nc.chunk = chunk
+        nc.createDimension('time', nT)
+        nc.createDimension('band', 4)
+        nc.createDimension('y', tile_size)
+        nc.createDimension('x', tile_size)
+        nc.createDimension('yblock', nblk)
+        nc.createDimension('xblock', nblk)
+        time = nc.createVariable('time', 'i4', ('time',))
+        time.units = f"days since {nc.start_date}"
+        time[:] = np.arange(nT)
+        # per block as a file can fail to read for some blocks only
+        status = nc.createVariable('status', 'u1', ('yblock', 'xblock', 'time'),
+                                   fill_value=0)
+        status.comment = "0 no file, 1 read, 2 could not be read"
+        opts = dict(zlib=True, shuffle=True)
+        nc.createVariable('refl', 'f4', ('time', 'band', 'y', 'x'),
+                          chunksizes=(nT, 1, chunk, chunk), **opts)
+        nc.createVariable('qa', 'u1', ('time', 'y', 'x'),
+                          chunksizes=(nT, chunk, chunk), **opts)
+        for name in ['vza', 'sza', 'raa']:
+            nc.createVariable(name, 'f4', ('time', 'y', 'x'),
+                              chunksizes=(nT, chunk, chunk), **opts)
+        nc.createVariable('done', 'u1', ('yblock', 'xblock'), fill_value=0)
+
+
+def export_tile(tile, start_date, end_date, fname, tile_size=TILE_SIZE,
+                chunk=STORE_CHUNK, n_threads=8):
+    """
+    Reads the daily files of a tile block by block into a store
+
+    Blocks already in the store are skipped. Returns the number
+    of blocks written.
+    """
+    if not os.path.exists(fname):
+        create_store(fname, tile, start_date, end_date, tile_size, chunk)
+    n = 0
+    with netCDF4.Dataset(fname, 'a') as nc:
+        nc.set_auto_mask(False)
+        blocks = make_chunks(tile_size, nc.chunk)
+        for y0, y1, x0, x1 in blocks:
+            by, bx = y0 // nc.chunk, x0 // nc.chunk
+            if nc['done'][by, bx]:
+                continue
+            o = OLCI_refl(tile, start_date, end_date, x0, y0, x1, y1,
+                          n_threads=n_threads)
+            data = o.read_files()
+            nc['refl'][:, :, y0:y1, x0:x1] = data['refl']
+            nc['qa'][:, y0:y1, x0:x1] = data['qa']
+            for name in ['vza', 'sza', 'raa']:
+                nc[name][:, y0:y1, x0:x1] = data[name]
+            status = np.zeros(len(nc.dimensions['time']), dtype=np.uint8)
+            for d in data['date']:
+                status[(d - start_date).days] = 2 if d in data['failed'] else 1
+            nc['status'][by, bx] = status
+            nc['done'][by, bx] = 1
+            nc.sync()
+            n += 1
+            LOG.info(f"{tile}: block y{y0}:{y1} x{x0}:{x1} written "
+                     f"({len(data['date'])} days)")
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Consolidate the daily gridded OLCI files of a tile into a chunked NetCDF store.')
+    parser.add_argument('tile', help='MODIS tile eg h20v08')
+    parser.add_argument('start', help='Start date YYYY-MM-DD')
+    parser.add_argument('end', help='End date YYYY-MM-DD (not included)')
+    parser.add_argument('fname', help='Output store eg h20v08_2019.nc')
+    parser.add_argument('--chunk', type=int, default=STORE_CHUNK,
+                        help='Spatial chunk size in pixels')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Threads reading the daily files')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start_date = datetime.datetime.strptime(args.start, "%Y-%m-%d")
+    end_date = datetime.datetime.strptime(args.end, "%Y-%m-%d")
+    n = export_tile(args.tile, start_date, end_date, args.fname,
+                    chunk=args.chunk, n_threads=args.threads)
+    print(f"{n} blocks written to {args.fname}")
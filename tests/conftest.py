@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the s3_olci modules import each other as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "s3_olci"))
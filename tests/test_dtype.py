@@ -0,0 +1,44 @@
+"""
+float32 edge_preserving against float64 on the benchmarks.py cube
+"""
+import numpy as np
+import pytest
+
+import regularisation
+from benchmarks import synthetic_refl
+
+
+@pytest.fixture(scope="module")
+def runs():
+    refl = np.stack([synthetic_refl(180, 30, 30, seed=band)
+                     for band in range(4)], axis=1)
+    return {dtype: regularisation.edge_preserving("OLCI", refl, dtype=dtype)
+            for dtype in [np.float64, np.float32]}
+
+
+def test_dtype(runs):
+    s32, u32 = runs[np.float32]
+    assert s32.dtype == np.float32 and u32.dtype == np.float32
+
+
+def test_solutions(runs):
+    s64, _ = runs[np.float64]
+    s32, _ = runs[np.float32]
+    # pixels float32 can't solve are re-solved in float64
+    np.testing.assert_array_equal(np.isfinite(s32), np.isfinite(s64))
+    ok = np.isfinite(s64)
+    np.testing.assert_allclose(s32[ok], s64[ok], rtol=0, atol=1e-3)
+    assert np.median(np.abs(s32[ok] - s64[ok])) < 1e-6
+
+
+def test_uncs(runs):
+    _, u64 = runs[np.float64]
+    _, u32 = runs[np.float32]
+    np.testing.assert_array_equal(np.isnan(u32), np.isnan(u64))
+    # variances over 1 are days the obs don't constrain, float64 has
+    # them as huge numbers and float32 can overflow to inf
+    free64 = ~(np.abs(u64) <= 1)
+    free32 = ~(np.abs(u32) <= 1)
+    np.testing.assert_array_equal(free32, free64)
+    ok = ~free64
+    np.testing.assert_allclose(u32[ok], u64[ok], rtol=1e-2, atol=1e-12)